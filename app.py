@@ -1,29 +1,34 @@
-from flask import Flask, redirect, render_template, request, make_response, session, abort, jsonify, url_for
+from flask import Flask, redirect, render_template, request, make_response, session, abort, jsonify, url_for, Response, stream_with_context
 import secrets
+import click
+import binascii
+import json
+import hashlib
 from functools import wraps
 from firebase_admin import firestore, auth
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore_v1.field_path import FieldPath
 from datetime import timedelta, datetime
 import os
 from dotenv import load_dotenv
-from crud import upload_file_to_cloudinary
+from crud import upload_files_concurrently, upload_media, hash_file, lookup_media_hashes, is_data_url, data_url_to_file, write_behind_queue
+from cache import create_cache
+from media_jobs import media_job_queue, MEDIA_JOBS_DB, MEDIA_SPOOL_DIR, MEDIA_JOB_WORKERS, MEDIA_JOB_MAX_ATTEMPTS
+from vector_index import vector_index, embed, quantize, best_passage, VECTOR_DIM
+from search_index import search_index, tokenize, entry_search_text, shard_id
 from firebase_config import db
 import base64
 from io import BytesIO
-import google.generativeai as genai
+import llm_client
 from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
 import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from collections import deque
 
 load_dotenv()
 
-# Configure Gemini API
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-pro')
-else:
-    print("⚠️ Warning: GEMINI_API_KEY not found in environment variables")
-    model = None
+# Gemini is configured once in llm_client (shared, cached models)
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY')
@@ -37,8 +42,9 @@ from flask_cors import CORS
 CORS(app, resources={
     r"/api/*": {
         "origins": "*",
-        "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"]
+        "methods": ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
+        "allow_headers": ["Content-Type", "Authorization"],
+        "expose_headers": ["X-Next-Cursor", "ETag"]
     }
 })
 
@@ -52,6 +58,17 @@ app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # Can be 'Strict', 'Lax', or 'Non
 # Firebase is already initialized in firebase_config.py
 # Just import db from there (done above)
 
+# Read caches, keyed by uid. CACHE_BACKEND=redis shares them across gunicorn
+# workers so invalidations are seen by every worker.
+CACHE_MAX_ENTRIES = int(os.getenv('CONTEXT_CACHE_MAX_ENTRIES', '2048'))
+context_cache = create_cache('chat_context', ttl=int(os.getenv('CONTEXT_CACHE_TTL', '300')), max_entries=CACHE_MAX_ENTRIES)
+history_cache = create_cache('chat_history', ttl=int(os.getenv('CHAT_HISTORY_CACHE_TTL', '60')), max_entries=CACHE_MAX_ENTRIES)
+entries_cache = create_cache('entries_list', ttl=int(os.getenv('ENTRIES_CACHE_TTL', '300')), max_entries=CACHE_MAX_ENTRIES)
+
+# Media uploads run in the background by default; set ASYNC_MEDIA_UPLOADS=0
+# to upload inside the save request instead
+ASYNC_MEDIA_UPLOADS = os.getenv('ASYNC_MEDIA_UPLOADS', '1') == '1'
+
 ########################################
 """ Authentication and Authorization """
 
@@ -136,11 +153,125 @@ def dashboard():
     print(session)
     return render_template('dashboard.html')
 
+#########################################################
+""" Conditional Responses """
+
+def conditional_json(payload, etag=None):
+    """
+    JSON response for GET endpoints with a strong ETag (the given one, or a
+    hash of the body) and private, always-revalidated caching. Returns an
+    empty 304 when the client's If-None-Match already names this version.
+    """
+    response = make_response(jsonify(payload), 200)
+    if etag:
+        response.headers['ETag'] = etag
+    else:
+        response.add_etag()
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+#########################################################
+""" Pagination Helpers """
+
+# Page sizes for the listing APIs (requests above the max are clamped)
+ENTRIES_PAGE_SIZE = int(os.getenv('ENTRIES_PAGE_SIZE', '50'))
+ENTRIES_MAX_PAGE_SIZE = int(os.getenv('ENTRIES_MAX_PAGE_SIZE', '100'))
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', '50'))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_MAX_PAGE_SIZE', '100'))
+
+ENTRY_LIST_FIELDS = ('date_id', 'title', 'created_at', 'updated_at', 'preview', 'block_counts', 'word_count')
+CHAT_MESSAGE_FIELDS = ('timestamp', 'sender', 'message', 'chat_id', 'response', 'response_timestamp')
+
+# Keys each endpoint's cursor must carry, with the parser its value must pass
+ENTRY_CURSOR_FIELDS = {'c': str, 'd': str}
+CHAT_CURSOR_FIELDS = {'t': datetime.fromisoformat}
+
+
+def encode_cursor(position):
+    """Opaque, URL-safe page cursor"""
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError for tampered or malformed cursors"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(position, dict):
+        raise ValueError('Invalid cursor')
+    return position
+
+
+def parse_page_args(default_size, max_size, allowed_fields, cursor_fields):
+    """
+    Read limit / cursor / fields from the query string.
+    Returns (limit, cursor, fields) with limit clamped to [1, max_size] and
+    fields None when no projection was asked for. The cursor must carry every
+    key of cursor_fields as a string its parser accepts. Raises ValueError on bad input.
+    """
+    limit = request.args.get('limit', default_size, type=int)
+    limit = max(1, min(limit, max_size))
+    
+    cursor = request.args.get('cursor') or None
+    if cursor:
+        position = decode_cursor(cursor)
+        for key, parse in cursor_fields.items():
+            try:
+                if not isinstance(position.get(key), str):
+                    raise ValueError
+                parse(position[key])
+            except (ValueError, TypeError):
+                raise ValueError('Invalid cursor')
+    
+    fields = None
+    if request.args.get('fields'):
+        fields = tuple(sorted({f.strip() for f in request.args['fields'].split(',') if f.strip()}))
+        unknown = [f for f in fields if f not in allowed_fields]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return limit, cursor, fields
+
+
 #########################################################
 """ Chat History Management """
 
+def on_chat_history_flushed(items):
+    """
+    Drop cached history for users whose queued messages just got committed,
+    and count the messages towards their next memory compaction
+    """
+    # Message path: artifacts/<app>/users/<uid>/models/<model>/messages/<id>
+    flushed = {}
+    for doc_ref, _ in items:
+        parts = doc_ref.path.split('/')
+        flushed[(parts[3], parts[5])] = flushed.get((parts[3], parts[5]), 0) + 1
+    for uid in {uid for uid, _ in flushed}:
+        history_cache.invalidate_user(uid)
+    for (uid, model_name), count in flushed.items():
+        try:
+            compaction_executor.submit(record_chat_messages, uid, model_name, count)
+        except RuntimeError:
+            # Executor already shut down (final flush at exit): count only
+            record_chat_messages(uid, model_name, count, compact=False)
+
+
+# Chat messages are buffered and committed in batches off the request path
+chat_history_writer = write_behind_queue(
+    'chat_history',
+    max_size=int(os.getenv('CHAT_WRITE_QUEUE_SIZE', '1000')),
+    batch_size=int(os.getenv('CHAT_WRITE_BATCH_SIZE', '100')),
+    flush_interval=float(os.getenv('CHAT_WRITE_FLUSH_INTERVAL', '0.5')),
+    on_flush=on_chat_history_flushed
+)
+
+
 def save_chat_history(uid, chat_id, message, sender, response=None, model_name='fumiko'):
-    """Save chat message to Firestore for a specific model"""
+    """
+    Save chat message to Firestore for a specific model.
+    The write is queued (write-behind) and committed by a background batch flush.
+    """
     try:
         # Save to model-specific messages subcollection
         chat_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('models').document(model_name).collection('messages')
@@ -156,16 +287,162 @@ def save_chat_history(uid, chat_id, message, sender, response=None, model_name='
             doc_data['response'] = response
             doc_data['response_timestamp'] = datetime.utcnow()
         
-        chat_ref.add(doc_data)
+        chat_history_writer.enqueue(chat_ref.document(), doc_data)
+        history_cache.invalidate_user(uid)
         return True
     except Exception as e:
         print(f"Error saving chat history: {e}")
         return False
 
 
-def get_chat_history(uid, limit=10, model_name='fumiko'):
-    """Retrieve chat history for a specific model"""
+# Rolling conversation memory: older messages are folded into one summary
+# document per user and model, so chat prompts only need it plus the
+# messages newer than the last fold
+CHAT_CONTEXT_MESSAGES = int(os.getenv('CHAT_CONTEXT_MESSAGES', '5'))
+CHAT_MEMORY_COMPACT_EVERY = int(os.getenv('CHAT_MEMORY_COMPACT_EVERY', '20'))
+CHAT_MEMORY_FOLD_BATCH = int(os.getenv('CHAT_MEMORY_FOLD_BATCH', '50'))
+CHAT_MEMORY_MAX_CHARS = int(os.getenv('CHAT_MEMORY_MAX_CHARS', '2000'))
+CHAT_MEMORY_LEASE_SECONDS = int(os.getenv('CHAT_MEMORY_LEASE_SECONDS', '300'))
+
+compaction_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='chat-memory')
+
+
+def get_chat_memory_ref(uid, model_name='fumiko'):
+    """Rolling summary of the conversation older than the recent messages"""
+    return db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('models').document(model_name).collection('memory').document('summary')
+
+
+def get_chat_memory(uid, model_name='fumiko'):
+    """
+    Summary of earlier conversations and the timestamp of the last message
+    folded into it, as {'summary', 'compacted_until'} (cached per uid and model)
+    """
+    def load():
+        memory_doc = get_chat_memory_ref(uid, model_name).get()
+        memory = memory_doc.to_dict() if memory_doc.exists else {}
+        return {'summary': memory.get('summary', ''), 'compacted_until': memory.get('compacted_until')}
+    
+    try:
+        return context_cache.get_or_load(('chat_memory', uid, model_name), load)
+    except Exception as e:
+        print(f"Error fetching chat memory: {e}")
+        return {'summary': '', 'compacted_until': None}
+
+
+def record_chat_messages(uid, model_name, count, compact=True):
+    """
+    Add newly stored messages to the unfolded count kept in the memory
+    document, and compact once CHAT_MEMORY_COMPACT_EVERY messages beyond the
+    recent window are waiting. The count and a compaction lease live in
+    Firestore, so they hold across restarts and gunicorn workers. Every
+    compaction recounts from the messages it finds, so the count self-corrects.
+    """
+    memory_ref = get_chat_memory_ref(uid, model_name)
+    
+    @firestore.transactional
+    def claim(transaction):
+        snapshot = memory_ref.get(transaction=transaction)
+        memory = snapshot.to_dict() if snapshot.exists else {}
+        updates = {'unfolded_messages': max(memory.get('unfolded_messages', 0), 0) + count}
+        # Never counted (new conversation, or one older than the count):
+        # compact once so the count is taken from the stored messages
+        due = 'unfolded_messages' not in memory or updates['unfolded_messages'] >= CHAT_CONTEXT_MESSAGES + CHAT_MEMORY_COMPACT_EVERY
+        due = compact and due and memory.get('compacting_until', 0) < time.time()
+        if due:
+            updates['compacting_until'] = time.time() + CHAT_MEMORY_LEASE_SECONDS
+        transaction.set(memory_ref, updates, merge=True)
+        return due
+    
     try:
+        if claim(db.transaction()):
+            run_chat_compaction(uid, model_name)
+    except Exception as e:
+        print(f"⚠️ Could not count chat messages for user {uid}: {e}")
+
+
+def run_chat_compaction(uid, model_name):
+    try:
+        # Queued messages must be in Firestore before they can be folded
+        chat_history_writer.flush()
+        folded = compact_chat_memory(uid, model_name)
+        if folded:
+            print(f"🧠 Folded {folded} message(s) into {model_name} memory for user {uid}")
+    except Exception as e:
+        print(f"⚠️ Chat memory compaction failed for user {uid}: {e}")
+    finally:
+        try:
+            get_chat_memory_ref(uid, model_name).set({'compacting_until': firestore.DELETE_FIELD}, merge=True)
+        except Exception as e:
+            print(f"⚠️ Could not release chat memory lease for user {uid}: {e}")
+
+
+def compact_chat_memory(uid, model_name='fumiko'):
+    """
+    Fold every message older than the last CHAT_CONTEXT_MESSAGES (and not yet
+    folded) into the rolling summary, CHAT_MEMORY_FOLD_BATCH messages per
+    Gemini call. Returns the number of messages folded.
+    """
+    memory_ref = get_chat_memory_ref(uid, model_name)
+    memory_doc = memory_ref.get()
+    memory = memory_doc.to_dict() if memory_doc.exists else {}
+    
+    chat_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('models').document(model_name).collection('messages')
+    query = chat_ref.order_by('timestamp')
+    if memory.get('compacted_until'):
+        query = query.where('timestamp', '>', memory['compacted_until'])
+    pending = [doc.to_dict() for doc in query.stream()]
+    to_fold = pending[:-CHAT_CONTEXT_MESSAGES] if CHAT_CONTEXT_MESSAGES else pending
+    counted = memory.get('unfolded_messages', 0)
+    
+    @firestore.transactional
+    def save(transaction, updates, left):
+        # The count becomes the pending messages still unfolded, plus
+        # whatever was counted since it was last read (messages stored
+        # after the query above); returns the count written
+        snapshot = memory_ref.get(transaction=transaction)
+        current = snapshot.to_dict().get('unfolded_messages', 0) if snapshot.exists else 0
+        updates['unfolded_messages'] = left + max(current - counted, 0)
+        transaction.set(memory_ref, updates, merge=True)
+        return updates['unfolded_messages']
+    
+    if not to_fold:
+        save(db.transaction(), {}, len(pending))
+        return 0
+    
+    summary = memory.get('summary', '')
+    for start in range(0, len(to_fold), CHAT_MEMORY_FOLD_BATCH):
+        chunk = to_fold[start:start + CHAT_MEMORY_FOLD_BATCH]
+        transcript = '\n'.join(reversed(format_chat_history(chunk, model_name.capitalize())))
+        prompt = f"""You maintain the long-term memory of a journaling companion's conversations with one user.
+Update the memory below with the new conversation. Keep facts about the user, people and events
+they mentioned, their feelings, plans and anything they asked to be remembered; drop small talk.
+Write compact plain text, at most {CHAT_MEMORY_MAX_CHARS} characters.
+
+CURRENT MEMORY:
+{summary or '(empty)'}
+
+NEW CONVERSATION:
+{transcript}
+
+UPDATED MEMORY:"""
+        summary = llm_client.generate_text(prompt, llm_client.CHAT_MODEL, max_retries=2).strip()[:CHAT_MEMORY_MAX_CHARS]
+        
+        # Saved after every chunk so a failure never re-folds messages
+        folded = start + len(chunk)
+        counted = save(db.transaction(), {
+            'summary': summary,
+            'compacted_until': chunk[-1]['timestamp'],
+            'messages_compacted': memory.get('messages_compacted', 0) + folded,
+            'updated_at': datetime.utcnow()
+        }, len(pending) - folded)
+    
+    context_cache.invalidate(('chat_memory', uid, model_name))
+    return len(to_fold)
+
+
+def get_chat_history(uid, limit=10, model_name='fumiko'):
+    """Retrieve chat history for a specific model (cached per uid)"""
+    def load():
         # Query from model-specific messages subcollection
         chat_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('models').document(model_name).collection('messages')
         
@@ -178,36 +455,99 @@ def get_chat_history(uid, limit=10, model_name='fumiko'):
         
         # Reverse to get chronological order
         return list(reversed(chat_history))
+    
+    try:
+        return history_cache.get_or_load(('messages', uid, model_name, limit), load)
     except Exception as e:
         print(f"Error fetching chat history: {e}")
         return []
 
 
+def get_chat_history_page(uid, model_name='fumiko', limit=50, cursor=None, fields=None):
+    """
+    One page of chat history for the listing APIs, newest page first
+    (messages are chronological within a page). `cursor` continues with
+    older messages; `fields` projects the documents with Firestore select().
+    Returns (messages, next_cursor).
+    """
+    def load():
+        chat_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('models').document(model_name).collection('messages')
+        
+        query = chat_ref.order_by('timestamp', direction=firestore.Query.DESCENDING)
+        if fields:
+            # timestamp is always needed to build the next cursor
+            query = query.select(sorted(set(fields) | {'timestamp'}))
+        if cursor:
+            query = query.start_after({'timestamp': datetime.fromisoformat(decode_cursor(cursor)['t'])})
+        
+        # One extra document tells whether another page exists
+        docs = list(query.limit(limit + 1).stream())
+        messages = [doc.to_dict() for doc in docs[:limit]]
+        next_cursor = None
+        if len(docs) > limit and messages:
+            next_cursor = encode_cursor({'t': messages[-1]['timestamp'].isoformat()})
+        return list(reversed(messages)), next_cursor
+    
+    return history_cache.get_or_load(('page', uid, model_name, limit, cursor, fields), load)
+
+
 @app.route('/api/chat-history', methods=['GET'])
 @auth_required
 def get_model_chat_history():
-    """Fetch chat history for a specific model"""
+    """Fetch chat history for a specific model (cursor paginated)"""
     try:
         uid = session['user']['uid']
         model_name = request.args.get('model', 'fumiko')
-        limit = request.args.get('limit', 50, type=int)
+        try:
+            limit, cursor, fields = parse_page_args(CHAT_HISTORY_PAGE_SIZE, CHAT_HISTORY_MAX_PAGE_SIZE, CHAT_MESSAGE_FIELDS, CHAT_CURSOR_FIELDS)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        chat_history = get_chat_history(uid, limit=limit, model_name=model_name)
+        chat_history, next_cursor = get_chat_history_page(uid, model_name, limit, cursor, fields)
         
-        return jsonify({
+        return conditional_json({
             'success': True,
             'messages': chat_history,
-            'model': model_name
-        }), 200
+            'model': model_name,
+            'next_cursor': next_cursor
+        })
     except Exception as e:
         print(f"Error in get_model_chat_history: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/metrics', methods=['GET'])
+@auth_required
+def get_runtime_metrics():
+    """Runtime metrics (write queues, caches) of this worker"""
+    return jsonify({
+        'success': True,
+        'chat_history_writer': chat_history_writer.stats(),
+        'context_cache': context_cache.stats(),
+        'history_cache': history_cache.stats(),
+        'entries_cache': entries_cache.stats()
+    }), 200
+
+
 #########################################################
 """ AI Chat Endpoints """
 
-from function import chat_system
+from function import chat_system, entry_plain_text, format_chat_history
+
+def suggested_typing_delay_ms(user_message):
+    """
+    Typing pause (ms) the dashboard shows before revealing a reply.
+    Paced client-side so no server worker sleeps for UX.
+    """
+    return 2000 if len(user_message) <= 10 else 1000
+
+
+def krishna_reply(message):
+    """Reply for the Krishna model, shared by /api/krishna and its stream"""
+    # TODO: Implement Krishna model logic here
+    # For now, just a placeholder response
+    return f'Krishna received: {message}'
+
 
 @app.route('/api/krishna', methods=['POST'])
 @auth_required
@@ -223,9 +563,7 @@ def chat_krishna():
         print(f"Krishna - Message: {message}")
         print(f"Krishna - Context: {context}")
         
-        # TODO: Implement Krishna model logic here
-        # For now, just a placeholder response
-        krishna_response = f'Krishna received: {message}'
+        krishna_response = krishna_reply(message)
         
         # Save the chat to history with Krishna model name
         save_chat_history(uid, chat_id, message, 'user', krishna_response, model_name='krishna')
@@ -263,34 +601,23 @@ def fumiko_chat():
         print(f"  Message: {user_message[:50]}...")
         print(f"  Chat ID: {chat_id}")
         
-        # Fetch context data
+        # Fetch context data (all sources concurrently)
         print(f"  📚 Fetching context data...")
-        try:
-            past_entries_list = get_past_7_days_entries(uid)
-            print(f"    ✓ Past entries: {len(past_entries_list)}")
-        except Exception as e:
-            print(f"    ⚠️ Error fetching past entries: {e}")
-            past_entries_list = []
-        
-        try:
-            virtual_profile = get_user_virtual_profile(uid)
-            print(f"    ✓ Virtual profile: {'Found' if virtual_profile else 'Not found'}")
-        except Exception as e:
-            print(f"    ⚠️ Error fetching virtual profile: {e}")
-            virtual_profile = None
-        
-        try:
-            chat_history = get_chat_history(uid, limit=5, model_name='fumiko')
-            print(f"    ✓ Chat history: {len(chat_history)} messages")
-        except Exception as e:
-            print(f"    ⚠️ Error fetching chat history: {e}")
-            chat_history = []
+        context, timings = gather_chat_context(uid, model_name='fumiko', message=user_message)
+        past_entries_list = context['past_entries']
+        virtual_profile = context['virtual_profile']
+        chat_history = context['chat_history']
+        print(f"    ✓ Past entries: {len(past_entries_list)}")
+        print(f"    ✓ Virtual profile: {'Found' if virtual_profile else 'Not found'}")
+        print(f"    ✓ Chat history: {len(chat_history)} messages")
+        print(f"    ⏱️ Context timings (ms): {timings}")
         
         # Call Fumiko AI
         print(f"  🤖 Calling Fumiko AI...")
         try:
-            a = chat_system(provided_context, past_entries_list, chat_history, virtual_profile)
+            a = chat_system(provided_context, past_entries_list, chat_history, virtual_profile, context['chat_memory'])
             fumiko_response = a.chat_fumiko(user_message)
+            print(f"    ✓ Prompt context tokens (est.): {a.context_usage}")
             print(f"    ✓ Response generated: {len(fumiko_response)} chars")
         except Exception as ai_error:
             print(f"    ❌ AI Error: {ai_error}")
@@ -298,12 +625,6 @@ def fumiko_chat():
             traceback.print_exc()
             return jsonify({'error': f'AI service error: {str(ai_error)}'}), 503
         
-        # Add delay for better UX
-        if len(user_message) <= 10:
-            time.sleep(2)
-        else:
-            time.sleep(1)
-        
         # Save chat history
         print(f"  💾 Saving to database...")
         try:
@@ -321,7 +642,8 @@ def fumiko_chat():
         return jsonify({
             'response': fumiko_response,
             'model': 'fumiko',
-            'success': True
+            'success': True,
+            'typing_delay_ms': suggested_typing_delay_ms(user_message)
         }), 200
         
     except Exception as e:
@@ -334,6 +656,81 @@ def fumiko_chat():
         }), 500
 
 
+def sse_event(data, event=None):
+    """Format one Server-Sent Event frame with a JSON payload"""
+    frame = f"event: {event}\n" if event else ''
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+
+def stream_chat_response(uid, chat_id, user_message, chunks, model_name):
+    """
+    Relay reply chunks to the client as SSE and save the full reply to
+    chat history once the stream has completed.
+    """
+    def generate():
+        parts = []
+        try:
+            for chunk in chunks:
+                parts.append(chunk)
+                yield sse_event({'chunk': chunk})
+        except Exception as e:
+            print(f"  ❌ Stream error ({model_name}): {e}")
+            yield sse_event({'error': f'AI service error: {str(e)}'}, event='error')
+            return
+        
+        full_response = ''.join(parts)
+        if not save_chat_history(uid, chat_id, user_message, 'user', full_response, model_name=model_name):
+            print(f"  ⚠️ Chat save returned False ({model_name} stream)")
+        yield sse_event({'response': full_response, 'model': model_name, 'success': True}, event='done')
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/api/fumiko/stream', methods=['POST'])
+@auth_required
+def fumiko_chat_stream():
+    """Stream Fumiko's reply over Server-Sent Events"""
+    try:
+        uid = session['user']['uid']
+        data = request.get_json()
+        user_message = data.get('message', '').strip()
+        provided_context = data.get('context', '')
+        chat_id = data.get('chat_id', 'default')
+        
+        if not user_message:
+            return jsonify({'error': 'Message cannot be empty'}), 400
+        
+        print(f"\n🤖 Fumiko Stream Request - User ID: {uid}")
+        context, timings = gather_chat_context(uid, model_name='fumiko', message=user_message)
+        print(f"    ⏱️ Context timings (ms): {timings}")
+        
+        a = chat_system(provided_context, context['past_entries'], context['chat_history'], context['virtual_profile'], context['chat_memory'])
+        return stream_chat_response(uid, chat_id, user_message, a.stream_fumiko(user_message), 'fumiko')
+    except Exception as e:
+        print(f"  ❌ Error in fumiko_chat_stream: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/krishna/stream', methods=['POST'])
+@auth_required
+def chat_krishna_stream():
+    """Stream Krishna's reply over Server-Sent Events"""
+    try:
+        uid = session['user']['uid']
+        data = request.get_json()
+        message = data.get('message', '')
+        chat_id = data.get('chat_id', 'default')
+        
+        return stream_chat_response(uid, chat_id, message, iter([krishna_reply(message)]), 'krishna')
+    except Exception as e:
+        print(f"Error in chat_krishna_stream: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
 #########################################################
 """ Journal Entry Management """
 
@@ -374,6 +771,360 @@ def test_upload():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+ENTRY_PREVIEW_CHARS = 200
+
+
+def get_entry_index_ref(uid):
+    """State of the per-user summary index used by the entry list (complete/sharded flags)"""
+    return db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entry_index').document('summary')
+
+
+def get_summary_shard_ref(uid, date_id):
+    """Monthly document of the summary index holding the entry's summary"""
+    return db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('summary_index').document(shard_id(date_id))
+
+
+def set_entry_summary(writer, uid, date_id, summary):
+    """
+    Write (part of) an entry's summary into its monthly shard. Each given
+    field is replaced as a whole, so nested maps such as block_counts keep
+    no stale keys; fields not given (e.g. created_at) are left alone.
+    """
+    writer.set(
+        get_summary_shard_ref(uid, date_id),
+        {'entries': {date_id: summary}},
+        merge=[FieldPath('entries', date_id, key) for key in summary]
+    )
+
+
+def build_entry_summary(entry_data):
+    """Small summary of an entry: title, preview snippet, block-type counts and word count"""
+    blocks = entry_data.get('blocks', [])
+    block_counts = {}
+    word_count = 0
+    for block in blocks:
+        block_type = block.get('type') or 'unknown'
+        block_counts[block_type] = block_counts.get(block_type, 0) + 1
+        word_count += len((block.get('text') or '').split()) + len((block.get('caption') or '').split())
+    
+    preview = []
+    if blocks:
+        first = blocks[0]
+        preview.append({
+            'type': first.get('type'),
+            'text': (first.get('text') or '')[:ENTRY_PREVIEW_CHARS],
+            'caption': (first.get('caption') or '')[:ENTRY_PREVIEW_CHARS]
+        })
+    
+    return {
+        'title': entry_data.get('title', 'Untitled Entry'),
+        'preview': preview,
+        'block_counts': block_counts,
+        'word_count': word_count,
+        'updated_at': entry_data.get('updated_at')
+    }
+
+
+def entry_sort_key(entry):
+    """Sort/cursor key of an entry list item: (created_at ISO string, date_id)"""
+    created_at = entry.get('created_at')
+    return (created_at.isoformat() if created_at else '', entry['date_id'])
+
+
+def add_entry_index_writes(writer, uid, date_id, entry_data, summary=None):
+    """Queue the per-user index updates for a saved entry on a batch or transaction"""
+    set_entry_summary(writer, uid, date_id, summary or build_entry_summary(entry_data))
+    writer.set(get_vector_shard_ref(uid, date_id), {'vectors': {date_id: entry_vector(entry_data)}}, merge=True)
+    writer.set(get_search_shard_ref(uid, date_id), {'entries': {date_id: entry_search_doc(entry_data)}}, merge=True)
+
+
+def add_entry_index_deletes(writer, uid, date_id):
+    """Queue the removal of a deleted entry from every per-user index"""
+    writer.set(get_summary_shard_ref(uid, date_id), {'entries': {date_id: firestore.DELETE_FIELD}}, merge=True)
+    writer.set(get_vector_shard_ref(uid, date_id), {'vectors': {date_id: firestore.DELETE_FIELD}}, merge=True)
+    writer.set(get_search_shard_ref(uid, date_id), {'entries': {date_id: firestore.DELETE_FIELD}}, merge=True)
+
+
+def write_entry(uid, date_id, entry_data):
+    """
+    Create-or-update an entry together with its index entries, without
+    reading it first. The update is tried first (existing entries, the
+    common case, cost one write); if the entry does not exist yet it is
+    created with created_at instead. Returns True when the entry was created.
+    """
+    entry_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entries').document(date_id)
+    summary = build_entry_summary(entry_data)
+    
+    batch = db.batch()
+    batch.update(entry_ref, entry_data)
+    add_entry_index_writes(batch, uid, date_id, entry_data, summary)
+    try:
+        batch.commit()
+        return False
+    except google_exceptions.NotFound:
+        pass
+    
+    summary['created_at'] = firestore.SERVER_TIMESTAMP
+    batch = db.batch()
+    batch.create(entry_ref, dict(entry_data, created_at=firestore.SERVER_TIMESTAMP))
+    add_entry_index_writes(batch, uid, date_id, entry_data, summary)
+    try:
+        batch.commit()
+    except google_exceptions.AlreadyExists:
+        # Created by a concurrent save in between, so this is an update after all
+        return write_entry(uid, date_id, entry_data)
+    return True
+
+
+# Block fields a PATCH may change; media state is only set by the server
+BLOCK_PATCH_FIELDS = ('type', 'text', 'caption', 'fileName', 'fileSize', 'url')
+MEDIA_STATE_FIELDS = ('media_status', 'media_job_id')
+ENTRY_PATCH_FIELDS = ('title', 'theme', 'font')
+BLOCK_OPS = ('insert', 'update', 'delete', 'move')
+
+
+def apply_block_changes(blocks, changed_blocks, block_order=None):
+    """
+    Merge changed blocks (matched by id, unknown ids are appended) into the
+    stored block list. block_order, when given, is the full list of block ids
+    in their new order; blocks it leaves out are removed.
+    Raises ValueError for malformed changes.
+    """
+    merged = [dict(block) for block in blocks]
+    by_id = {block.get('id'): block for block in merged}
+    
+    for change in changed_blocks:
+        if not isinstance(change, dict) or change.get('id') is None:
+            raise ValueError('Every changed block needs an id')
+        if is_data_url(change.get('url')):
+            raise ValueError('Media files must be saved with POST /api/entries')
+        block = by_id.get(change['id'])
+        if block is None:
+            if not change.get('type'):
+                raise ValueError(f"New block {change['id']} needs a type")
+            block = {'id': change['id'], 'text': '', 'caption': ''}
+            merged.append(block)
+            by_id[change['id']] = block
+        for field in BLOCK_PATCH_FIELDS:
+            if field in change:
+                block[field] = change[field]
+    
+    if block_order is not None:
+        if not isinstance(block_order, list):
+            raise ValueError('block_order must be a list of block ids')
+        unknown = [block_id for block_id in block_order if block_id not in by_id]
+        if unknown:
+            raise ValueError(f"Unknown block ids in block_order: {unknown}")
+        merged = [by_id[block_id] for block_id in dict.fromkeys(block_order)]
+    
+    return merged
+
+
+def check_block_op(op):
+    """Raise ValueError unless op has the shape of one of the block ops below"""
+    if not isinstance(op, dict) or op.get('op') not in BLOCK_OPS:
+        raise ValueError(f"Unknown block op: {op}")
+    if op['op'] == 'insert':
+        new_block = op.get('block')
+        if not isinstance(new_block, dict) or new_block.get('id') is None or not new_block.get('type'):
+            raise ValueError('insert needs a block with an id and a type')
+    elif op['op'] == 'update' and not isinstance(op.get('fields') or {}, dict):
+        raise ValueError('update fields must be an object')
+
+
+def apply_block_ops(blocks, ops):
+    """
+    Apply block-level ops, in order, to a copy of the stored blocks:
+      {"op": "insert", "block": {...}, "after": <block id> | null}
+      {"op": "update", "id": <block id>, "fields": {...}}
+      {"op": "delete", "id": <block id>}
+      {"op": "move", "id": <block id>, "after": <block id> | null}
+    `after: null` means the start of the entry. Raises ValueError on bad ops.
+    """
+    merged = [dict(block) for block in blocks]
+    
+    def position(block_id):
+        for i, block in enumerate(merged):
+            if block.get('id') == block_id:
+                return i
+        raise ValueError(f"Unknown block id {block_id}")
+    
+    def insert_after(block, after):
+        merged.insert(0 if after is None else position(after) + 1, block)
+    
+    def copy_fields(block, payload):
+        if is_data_url(payload.get('url')):
+            raise ValueError('Inline media must be sent as a file_<block id> upload')
+        block.update({field: payload[field] for field in BLOCK_PATCH_FIELDS + MEDIA_STATE_FIELDS if field in payload})
+        if 'url' in payload and 'media_status' not in payload:
+            # A new URL supersedes any pending or failed upload of the block
+            for field in MEDIA_STATE_FIELDS:
+                block.pop(field, None)
+    
+    for op in ops:
+        check_block_op(op)
+        kind = op['op']
+        if kind == 'insert':
+            new_block = op['block']
+            if any(block.get('id') == new_block['id'] for block in merged):
+                raise ValueError(f"Block {new_block['id']} already exists")
+            block = {'id': new_block['id'], 'text': '', 'caption': ''}
+            copy_fields(block, new_block)
+            insert_after(block, op.get('after'))
+        elif kind == 'update':
+            copy_fields(merged[position(op.get('id'))], op.get('fields') or {})
+        elif kind == 'delete':
+            merged.pop(position(op.get('id')))
+        else:
+            block = merged.pop(position(op.get('id')))
+            insert_after(block, op.get('after'))
+    
+    return merged
+
+
+def rebuild_entry_index(uid):
+    """
+    Build the monthly summary shards from the entry documents (once per user,
+    for entries written before the index existed or while it was a single
+    document, whose map is dropped). Returns the summaries.
+    """
+    entries_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entries')
+    summaries = {}
+    shards = {}
+    for doc in entries_ref.stream():
+        entry_data = doc.to_dict()
+        summary = build_entry_summary(entry_data)
+        summary['created_at'] = entry_data.get('created_at')
+        summaries[doc.id] = summary
+        shards.setdefault(shard_id(doc.id), {})[doc.id] = summary
+    
+    batch = db.batch()
+    for month, entries in shards.items():
+        batch.set(get_summary_shard_ref(uid, month), {'entries': entries})
+    batch.set(get_entry_index_ref(uid), {'entries': firestore.DELETE_FIELD, 'complete': True, 'sharded': True}, merge=True)
+    batch.commit()
+    print(f"🗂️ Rebuilt entry index for user {uid}: {len(summaries)} entries in {len(shards)} shard(s)")
+    return summaries
+
+
+def fallback_media_url(block):
+    """
+    URL a media block keeps when its new file fails to upload. Inline data
+    URLs are kept as they are until an upload succeeds (they are the only
+    copy of the media); migrate-inline-media moves them later.
+    """
+    if block.get('type') == 'document':
+        return ''
+    return block.get('url', '')
+
+
+def process_media_uploads(uid, date_id, uploads):
+    """
+    Resolve the media files of blocks about to be saved.
+    `uploads` is a list of (key, file, block, fallback_url), where a None
+    fallback leaves the block's url untouched on failure. Content this user
+    already uploaded reuses its URL; the rest is marked pending for the
+    background media queue (ASYNC_MEDIA_UPLOADS) or uploaded concurrently now.
+    Each block gets its url (or pending markers) written in place.
+    """
+    media = {'uploaded': 0, 'deduplicated': 0, 'failed': [], 'timings_ms': {}, 'pending': [], 'hashes': {}}
+    if not uploads:
+        return media
+    
+    # Reuse URLs of files this user already uploaded (content-addressed),
+    # so re-saving an entry uploads nothing
+    media['hashes'] = {key: hash_file(file) for key, file, _, _ in uploads}
+    known_urls = lookup_media_hashes(uid, media['hashes'].values())
+    remaining = []
+    for key, file, block, fallback_url in uploads:
+        known_url = known_urls.get(media['hashes'][key])
+        if known_url:
+            block['url'] = known_url
+            media['deduplicated'] += 1
+        else:
+            remaining.append((key, file, block, fallback_url))
+    if media['deduplicated']:
+        print(f"♻️ {media['deduplicated']} file(s) already uploaded, reusing their URLs")
+    
+    # Async mode: media blocks are saved as pending and uploaded by the
+    # background media job queue once the entry itself is stored
+    if remaining and ASYNC_MEDIA_UPLOADS:
+        for key, file, block, _ in remaining:
+            job_id = media_jobs.new_job_id()
+            block['url'] = ''
+            block['media_status'] = 'pending'
+            block['media_job_id'] = job_id
+            media['pending'].append((job_id, key, file, block))
+    elif remaining:
+        # Upload all media files at once through the bounded upload pool
+        print(f"\n📤 Uploading {len(remaining)} file(s) concurrently...")
+        results = upload_files_concurrently([(key, file) for key, file, _, _ in remaining], uid, date_id, media['hashes'])
+        for key, file, block, fallback_url in remaining:
+            result = results[key]
+            media['timings_ms'][key] = result['elapsed_ms']
+            if result['url']:
+                block['url'] = result['url']
+                media['uploaded'] += 1
+                print(f"  📤 Block {key} uploaded in {result['elapsed_ms']}ms: {result['url'][:50]}...")
+            else:
+                if fallback_url is None:
+                    # Keep whatever URL the stored block already has
+                    block.pop('url', None)
+                else:
+                    block['url'] = fallback_url
+                media['failed'].append({
+                    'block_id': block.get('id', key),
+                    'file_name': file.filename,
+                    'error': result['error']
+                })
+                print(f"  ❌ Block {key} upload failed: {result['error']}")
+    return media
+
+
+def resume_media_job(uid, date_id, job_id, processed_block):
+    """
+    Media state for a block re-saved without a URL that still references an
+    upload job (e.g. from an editor loaded before the upload finished): the
+    job's URL once it is done, 'failed' once it failed, otherwise the pending
+    link. Returns [job_id] while the job is still queued, else [].
+    """
+    job = media_jobs.get_job(job_id)
+    if job is None or job['uid'] != uid or job['date_id'] != date_id:
+        return []
+    if job['status'] == 'done' and job['url']:
+        processed_block['url'] = job['url']
+        return []
+    processed_block['media_job_id'] = job_id
+    if job['status'] == 'failed':
+        processed_block['media_status'] = 'failed'
+        return []
+    processed_block['media_status'] = 'pending'
+    return [job_id]
+
+
+def submit_media_jobs(uid, date_id, media, saved_blocks):
+    """Queue the pending uploads of process_media_uploads once the entry is stored"""
+    for job_id, key, file, _ in media['pending']:
+        block_index = next((i for i, b in enumerate(saved_blocks) if b.get('media_job_id') == job_id), None)
+        if block_index is None:
+            # The block was removed again before it was saved
+            continue
+        block = saved_blocks[block_index]
+        media_jobs.submit(job_id, uid, date_id, block.get('id'), block_index, block.get('type'), file, media['hashes'][key])
+    if media['pending']:
+        print(f"📥 Queued {len(media['pending'])} media upload job(s)")
+
+
+def media_upload_report(media):
+    """Upload summary returned to the client"""
+    return {
+        'uploaded': media['uploaded'],
+        'deduplicated': media['deduplicated'],
+        'failed': media['failed'],
+        'timings_ms': media['timings_ms']
+    }
+
+
 @app.route('/api/entries', methods=['POST'])
 @auth_required
 def save_entry():
@@ -418,8 +1169,11 @@ def save_entry():
         elif not blocks:
             blocks = []
         
-        # Process each block and upload media files
+        # Process each block; media files are collected here and uploaded
+        # concurrently below, then stitched back in block order
         processed_blocks = []
+        uploads = []
+        resumed_jobs = []
         for idx, block in enumerate(blocks):
             processed_block = {
                 'id': block.get('id'),
@@ -428,88 +1182,83 @@ def save_entry():
                 'caption': block.get('caption', '')
             }
             
-            print(f"\n🔄 Processing block {idx}: type={block.get('type')}")
+            block_type = block.get('type')
+            print(f"\n🔄 Processing block {idx}: type={block_type}")
             
-            # Handle different block types
-            if block.get('type') == 'image':
-                # Check if we have a file upload or base64 data
+            # Handle media block types
+            if block_type in ('image', 'video', 'document', 'voice'):
                 file_key = f'file_{idx}'
-                print(f"  Looking for file_key: {file_key}")
-                print(f"  Available files: {list(request.files.keys())}")
-                
                 if file_key in request.files:
                     file = request.files[file_key]
-                    print(f"  ✅ Found file: {file.filename}")
-                    url = upload_file_to_cloudinary(file, uid, date_id)
-                    processed_block['url'] = url if url else block.get('url', '')
-                    print(f"  📤 Uploaded to: {processed_block['url'][:50]}...")
-                else:
-                    # Use existing base64 or URL
-                    print(f"  ⚠️ No file found, using base64 data")
-                    processed_block['url'] = block.get('url', '')
-                    
-            elif block.get('type') == 'video':
-                file_key = f'file_{idx}'
-                if file_key in request.files:
-                    file = request.files[file_key]
-                    print(f"  ✅ Found video file: {file.filename}")
-                    url = upload_file_to_cloudinary(file, uid, date_id)
-                    processed_block['url'] = url if url else block.get('url', '')
-                else:
-                    print(f"  ⚠️ No video file found, using base64 data")
-                    processed_block['url'] = block.get('url', '')
-                    
-            elif block.get('type') == 'document':
-                file_key = f'file_{idx}'
-                if file_key in request.files:
-                    file = request.files[file_key]
-                    print(f"  ✅ Found document: {file.filename}")
-                    url = upload_file_to_cloudinary(file, uid, date_id)
-                    processed_block['url'] = url if url else ''
-                    processed_block['fileName'] = block.get('fileName', file.filename)
-                    processed_block['fileSize'] = block.get('fileSize', '')
-                else:
+                    print(f"  ✅ Found {block_type} file: {file.filename}")
+                    uploads.append((idx, file))
+                    if block_type == 'document':
+                        processed_block['fileName'] = block.get('fileName', file.filename)
+                        processed_block['fileSize'] = block.get('fileSize', '')
+                elif block_type == 'document':
                     print(f"  ⚠️ No document file found")
                     processed_block['fileName'] = block.get('fileName', '')
                     processed_block['fileSize'] = block.get('fileSize', '')
-            
-            elif block.get('type') == 'voice':
-                file_key = f'file_{idx}'
-                if file_key in request.files:
-                    file = request.files[file_key]
-                    print(f"  ✅ Found voice file: {file.filename}")
-                    url = upload_file_to_cloudinary(file, uid, date_id)
-                    processed_block['url'] = url if url else block.get('url', '')
+                    if block.get('url') and not is_data_url(block['url']):
+                        processed_block['url'] = block['url']
+                    elif block.get('media_job_id'):
+                        resumed_jobs += resume_media_job(uid, date_id, block['media_job_id'], processed_block)
+                elif is_data_url(block.get('url')):
+                    # Inline base64 media is decoded and uploaded like any file,
+                    # never stored in the entry document
+                    print(f"  🔄 Decoding inline {block_type} data for upload")
+                    try:
+                        file_name = block.get('fileName') or f"{block_type}-{block.get('id') or idx}"
+                        uploads.append((idx, data_url_to_file(block['url'], file_name)))
+                    except (ValueError, binascii.Error) as decode_error:
+                        print(f"  ❌ Could not decode inline {block_type} data: {decode_error}")
+                        processed_block['url'] = ''
                 else:
-                    print(f"  ⚠️ No voice file found, using base64 data")
+                    # Use existing URL
+                    print(f"  ⚠️ No {block_type} file found, using existing URL")
                     processed_block['url'] = block.get('url', '')
+                    if not processed_block['url'] and block.get('media_job_id'):
+                        resumed_jobs += resume_media_job(uid, date_id, block['media_job_id'], processed_block)
             
             processed_blocks.append(processed_block)
         
+        # Media is deduplicated, then queued for background upload or
+        # uploaded concurrently, and stitched back in block order
+        media = process_media_uploads(uid, date_id, [
+            (idx, file, processed_blocks[idx], fallback_media_url(blocks[idx]))
+            for idx, file in uploads
+        ])
+        
         entry_data = {
             'title': title,
             'blocks': processed_blocks,
             'theme': theme,
             'font': font,
-            'updated_at': firestore.SERVER_TIMESTAMP
+            'updated_at': firestore.SERVER_TIMESTAMP,
+            'version': firestore.Increment(1)
         }
         
-        # Reference to the entry document
-        entry_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entries').document(date_id)
+        # Entry and its summary in the per-user entry index are written atomically
+        created = write_entry(uid, date_id, entry_data)
+        invalidate_user_entries(uid)
+        print(f"✅ Entry {'created' if created else 'updated'} successfully in Firestore!")
         
-        # Check if entry exists
-        existing_entry = entry_ref.get()
-        if not existing_entry.exists:
-            entry_data['created_at'] = firestore.SERVER_TIMESTAMP
+        # Hand media over to the background queue only after the entry exists,
+        # so a fast upload always finds its block to patch
+        submit_media_jobs(uid, date_id, media, processed_blocks)
         
-        entry_ref.set(entry_data, merge=True)
-        print(f"✅ Entry saved successfully to Firestore!")
+        # Jobs that finished while this save was in flight patch their
+        # block again, since the save just re-linked it as pending
+        for job_id in resumed_jobs:
+            media_jobs.reapply(job_id)
         
         return jsonify({
             'success': True,
             'message': 'Entry saved successfully',
             'date_id': date_id,
-            'blocks_saved': len(processed_blocks)
+            'blocks_saved': len(processed_blocks),
+            'uploads': media_upload_report(media),
+            'media_pending': len(media['pending']) + len(resumed_jobs)
         }), 201
     except Exception as e:
         print(f"❌ Error saving entry: {e}")
@@ -520,29 +1269,75 @@ def save_entry():
 @app.route('/api/entries', methods=['GET'])
 @auth_required
 def get_past_entries():
-    """Retrieve list of all past entries for the user"""
+    """
+    Retrieve past entries for the user, newest first, one page at a time.
+    The body stays a JSON array; the cursor for the next page is sent in the
+    X-Next-Cursor header (absent on the last page).
+    """
     try:
         uid = session['user']['uid']
-        
-        entries_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entries')
-        docs = entries_ref.order_by('created_at', direction=firestore.Query.DESCENDING).stream()
-        
-        entries = []
-        for doc in docs:
-            entry_data = doc.to_dict()
-            entries.append({
-                'date_id': doc.id,
-                'title': entry_data.get('title', 'Untitled Entry'),
-                'created_at': entry_data.get('created_at'),
-                'updated_at': entry_data.get('updated_at'),
-                'preview': entry_data.get('blocks', [])[:1]  # Get first block as preview
-            })
-        
-        return jsonify(entries), 200
+        try:
+            limit, cursor, fields = parse_page_args(ENTRIES_PAGE_SIZE, ENTRIES_MAX_PAGE_SIZE, ENTRY_LIST_FIELDS, ENTRY_CURSOR_FIELDS)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        def load():
+            # One read per month of summaries instead of every entry document
+            index_doc = get_entry_index_ref(uid).get()
+            index = index_doc.to_dict() if index_doc.exists else {}
+            if not index.get('complete') or not index.get('sharded'):
+                summaries = rebuild_entry_index(uid)
+            else:
+                shards_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('summary_index')
+                summaries = {}
+                for shard_doc in shards_ref.stream():
+                    summaries.update(shard_doc.to_dict().get('entries', {}))
+            
+            entries = []
+            for date_id, summary in summaries.items():
+                entries.append({
+                    'date_id': date_id,
+                    'title': summary.get('title', 'Untitled Entry'),
+                    'created_at': summary.get('created_at'),
+                    'updated_at': summary.get('updated_at'),
+                    'preview': summary.get('preview', []),
+                    'block_counts': summary.get('block_counts', {}),
+                    'word_count': summary.get('word_count', 0)
+                })
+            entries.sort(key=entry_sort_key, reverse=True)
+            return entries
+        
+        entries = entries_cache.get_or_load(('entries', uid), load)
+        
+        # Keyset pagination over (created_at, date_id), newest first
+        if cursor:
+            position = decode_cursor(cursor)
+            after = (position['c'], position['d'])
+            entries = [e for e in entries if entry_sort_key(e) < after]
+        page = entries[:limit]
+        
+        if fields:
+            page = [{k: e[k] for k in ('date_id',) + fields} for e in page]
+        
+        response = conditional_json(page)
+        if len(entries) > limit:
+            last = entry_sort_key(entries[limit - 1])
+            response.headers['X-Next-Cursor'] = encode_cursor({'c': last[0], 'd': last[1]})
+        return response
     except Exception as e:
         print(f"Error retrieving past entries: {e}")
         return jsonify({'error': str(e)}), 500
 
+# Most entries a single batchGet may ask for
+ENTRIES_BATCH_MAX = int(os.getenv('ENTRIES_BATCH_MAX', '100'))
+
+
+def entry_etag(entry_doc):
+    """Strong ETag of an entry, derived from the document's last update time"""
+    version = f"{entry_doc.id}:{entry_doc.update_time.isoformat()}"
+    return '"' + hashlib.sha1(version.encode('utf-8')).hexdigest() + '"'
+
+
 @app.route('/api/entries/<date_id>', methods=['GET'])
 @auth_required
 def get_entry(date_id):
@@ -559,11 +1354,209 @@ def get_entry(date_id):
         entry_data = entry_doc.to_dict()
         entry_data['date_id'] = date_id
         
-        return jsonify(entry_data), 200
+        return conditional_json(entry_data, etag=entry_etag(entry_doc))
     except Exception as e:
         print(f"Error retrieving entry: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/entries:batchGet', methods=['POST'])
+@auth_required
+def batch_get_entries():
+    """
+    Fetch several entries in one Firestore get_all round-trip.
+    Body: {"date_ids": [...], "etags": {date_id: etag}}. Entries whose ETag
+    still matches are listed under not_modified instead of being resent.
+    """
+    try:
+        uid = session['user']['uid']
+        data = request.get_json(silent=True) or {}
+        date_ids = data.get('date_ids')
+        known_etags = data.get('etags') or {}
+        
+        if not isinstance(date_ids, list) or not all(isinstance(d, str) and d for d in date_ids):
+            return jsonify({'error': 'date_ids must be a list of entry ids'}), 400
+        if not isinstance(known_etags, dict):
+            return jsonify({'error': 'etags must be an object'}), 400
+        date_ids = list(dict.fromkeys(date_ids))
+        if len(date_ids) > ENTRIES_BATCH_MAX:
+            return jsonify({'error': f'At most {ENTRIES_BATCH_MAX} entries per request'}), 400
+        
+        entries_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entries')
+        refs = [entries_ref.document(date_id) for date_id in date_ids]
+        
+        entries = {}
+        not_modified = []
+        missing = []
+        for entry_doc in (db.get_all(refs) if refs else []):
+            if not entry_doc.exists:
+                missing.append(entry_doc.id)
+                continue
+            etag = entry_etag(entry_doc)
+            if known_etags.get(entry_doc.id) == etag:
+                not_modified.append(entry_doc.id)
+                continue
+            entry_data = entry_doc.to_dict()
+            entry_data['date_id'] = entry_doc.id
+            entry_data['etag'] = etag
+            entries[entry_doc.id] = entry_data
+        
+        return jsonify({
+            'success': True,
+            'entries': entries,
+            'not_modified': not_modified,
+            'missing': missing
+        }), 200
+    except Exception as e:
+        print(f"Error batch retrieving entries: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/entries/<date_id>', methods=['PATCH'])
+@auth_required
+def patch_entry(date_id):
+    """
+    Autosave / delta save: apply only what changed to an existing entry.
+    Body (JSON, or form fields with JSON values when files are attached) may hold
+    title/theme/font, block-level `ops` (see apply_block_ops), and the older
+    `blocks` + `block_order` merge form. With `base_version` the save is
+    rejected with 409 if the entry changed since the client loaded it.
+    New media for an inserted or updated block is sent as file `file_<block id>`;
+    only those files are uploaded.
+    """
+    try:
+        uid = session['user']['uid']
+        if request.is_json:
+            data = request.get_json(silent=True)
+        else:
+            data = request.form.to_dict()
+            try:
+                for key in ('ops', 'blocks', 'block_order'):
+                    if isinstance(data.get(key), str):
+                        data[key] = json.loads(data[key])
+            except ValueError:
+                return jsonify({'error': f'{key} must be valid JSON'}), 400
+        if not isinstance(data, dict):
+            return jsonify({'error': 'JSON body required'}), 400
+        
+        fields = {key: data[key] for key in ENTRY_PATCH_FIELDS if key in data}
+        ops = data.get('ops') or []
+        changed_blocks = data.get('blocks') or []
+        block_order = data.get('block_order')
+        base_version = data.get('base_version')
+        if not isinstance(ops, list) or not isinstance(changed_blocks, list):
+            return jsonify({'error': 'ops and blocks must be lists'}), 400
+        try:
+            for op in ops:
+                check_block_op(op)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if base_version is not None:
+            try:
+                base_version = int(base_version)
+            except (TypeError, ValueError):
+                return jsonify({'error': 'base_version must be an integer'}), 400
+        if not fields and not ops and not changed_blocks and block_order is None:
+            return jsonify({'error': 'Nothing to update'}), 400
+        
+        entry_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entries').document(date_id)
+        fields['updated_at'] = firestore.SERVER_TIMESTAMP
+        
+        # Theme/font-only autosave without a version check: a single write, no read.
+        # A title change goes through the transaction below, since the search
+        # and vector indexes are built from the whole entry
+        if not ops and not changed_blocks and block_order is None and base_version is None and 'title' not in fields:
+            batch = db.batch()
+            batch.update(entry_ref, dict(fields, version=firestore.Increment(1)))
+            set_entry_summary(batch, uid, date_id, {'updated_at': fields['updated_at']})
+            try:
+                batch.commit()
+            except google_exceptions.NotFound:
+                return jsonify({'error': 'Entry not found'}), 404
+            invalidate_user_entries(uid)
+            return jsonify({'success': True, 'date_id': date_id, 'blocks_saved': None}), 200
+        
+        # Only media attached to inserted/updated blocks is processed
+        uploads = []
+        for op in ops:
+            payload = op.get('block') if op.get('op') == 'insert' else op.get('fields')
+            if not isinstance(payload, dict):
+                continue
+            for key in MEDIA_STATE_FIELDS:
+                payload.pop(key, None)
+            block_id = payload.get('id', op.get('id'))
+            file = request.files.get(f'file_{block_id}')
+            if file:
+                uploads.append((block_id, file, payload, '' if op.get('op') == 'insert' else None))
+        media = process_media_uploads(uid, date_id, uploads)
+        
+        @firestore.transactional
+        def apply_patch(transaction):
+            snapshot = entry_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return None, None
+            entry = snapshot.to_dict()
+            current_version = entry.get('version', 0)
+            if base_version is not None and base_version != current_version:
+                return 'conflict', current_version
+            
+            blocks = entry.get('blocks', [])
+            if changed_blocks or block_order is not None:
+                blocks = apply_block_changes(blocks, changed_blocks, block_order)
+            blocks = apply_block_ops(blocks, ops)
+            
+            updates = dict(fields, blocks=blocks, version=current_version + 1)
+            transaction.update(entry_ref, updates)
+            add_entry_index_writes(transaction, uid, date_id, dict(entry, **updates))
+            return blocks, current_version + 1
+        
+        try:
+            blocks, version = apply_patch(db.transaction())
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if blocks is None:
+            return jsonify({'error': 'Entry not found'}), 404
+        if blocks == 'conflict':
+            return jsonify({
+                'error': 'Entry was changed since base_version',
+                'base_version': base_version,
+                'version': version
+            }), 409
+        
+        invalidate_user_entries(uid)
+        submit_media_jobs(uid, date_id, media, blocks)
+        
+        return jsonify({
+            'success': True,
+            'date_id': date_id,
+            'version': version,
+            'ops_applied': len(ops),
+            'blocks_changed': len(changed_blocks),
+            'blocks_saved': len(blocks),
+            'uploads': media_upload_report(media),
+            'media_pending': len(media['pending'])
+        }), 200
+    except Exception as e:
+        print(f"Error patching entry: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/entries/<date_id>/media-status', methods=['GET'])
+@auth_required
+def get_entry_media_status(date_id):
+    """Progress of the background media uploads for an entry"""
+    try:
+        uid = session['user']['uid']
+        jobs = media_jobs.status_for_entry(uid, date_id)
+        
+        return jsonify({
+            'success': True,
+            'date_id': date_id,
+            'pending': sum(1 for job in jobs if job['status'] in ('pending', 'uploading')),
+            'failed': sum(1 for job in jobs if job['status'] == 'failed'),
+            'jobs': jobs
+        }), 200
+    except Exception as e:
+        print(f"Error retrieving media status: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/entries/<date_id>', methods=['DELETE'])
 @auth_required
 def delete_entry(date_id):
@@ -572,7 +1565,12 @@ def delete_entry(date_id):
         uid = session['user']['uid']
         
         entry_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entries').document(date_id)
-        entry_ref.delete()
+        
+        batch = db.batch()
+        batch.delete(entry_ref)
+        add_entry_index_deletes(batch, uid, date_id)
+        batch.commit()
+        invalidate_user_entries(uid)
         
         return jsonify({'success': True, 'message': 'Entry deleted successfully'}), 200
     except Exception as e:
@@ -580,14 +1578,106 @@ def delete_entry(date_id):
         return jsonify({'error': str(e)}), 500
 
 
+def get_search_shard_ref(uid, date_id):
+    """Monthly document of the user's search index holding the entry's tokens"""
+    return db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('search_index').document(shard_id(date_id))
+
+
+def get_search_meta_ref(uid):
+    return db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entry_index').document('search')
+
+
+def entry_search_doc(entry_data):
+    """Title and token stream stored for one entry in the search index"""
+    return {
+        'title': entry_data.get('title', 'Untitled Entry'),
+        'tokens': ' '.join(tokenize(entry_search_text(entry_data)))
+    }
+
+
+def rebuild_search_index(uid):
+    """Tokenize every entry of the user into the monthly search shards (once per user)"""
+    entries_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entries')
+    documents = {doc.id: entry_search_doc(doc.to_dict()) for doc in entries_ref.stream()}
+    
+    shards = {}
+    for date_id, document in documents.items():
+        shards.setdefault(shard_id(date_id), {})[date_id] = document
+    batch = db.batch()
+    for month, entries in shards.items():
+        batch.set(get_search_shard_ref(uid, month), {'entries': entries}, merge=True)
+    batch.set(get_search_meta_ref(uid), {'complete': True, 'rebuilt_at': datetime.utcnow()})
+    batch.commit()
+    print(f"🔎 Rebuilt search index for user {uid}: {len(documents)} entries in {len(shards)} shard(s)")
+    return documents
+
+
+def load_search_index(uid):
+    """The user's positional inverted index, built from the monthly shards (cached per uid)"""
+    def load():
+        meta_doc = get_search_meta_ref(uid).get()
+        if not meta_doc.exists or not meta_doc.to_dict().get('complete'):
+            return search_index(rebuild_search_index(uid))
+        
+        shards_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('search_index')
+        documents = {}
+        for shard_doc in shards_ref.stream():
+            documents.update(shard_doc.to_dict().get('entries', {}))
+        return search_index(documents)
+    
+    return context_cache.get_or_load(('search_index', uid), load)
+
+
+SEARCH_PAGE_SIZE = 20
+
+
+@app.route('/api/search', methods=['GET'])
+@auth_required
+def search_entries():
+    """
+    Full-text search over the user's entries: words and "quoted phrases"
+    (all must match), optional from/to date filters (YYYY-MM-DD) and limit.
+    Served from the in-memory inverted index, not by scanning entries.
+    """
+    try:
+        uid = session['user']['uid']
+        query = request.args.get('q', '').strip()
+        date_from = request.args.get('from') or None
+        date_to = request.args.get('to') or None
+        limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), ENTRIES_MAX_PAGE_SIZE))
+        
+        if not query:
+            return jsonify({'error': 'Query parameter q is required'}), 400
+        try:
+            for value in (date_from, date_to):
+                if value:
+                    datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            return jsonify({'error': 'from/to must be dates in YYYY-MM-DD format'}), 400
+        
+        index = load_search_index(uid)
+        total, results = index.search(query, date_from, date_to, limit)
+        
+        return conditional_json({
+            'success': True,
+            'query': query,
+            'total': total,
+            'results': results
+        })
+    except Exception as e:
+        print(f"Error searching entries: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
     # ==================== GEMINI API - Virtual Profile Analysis ====================
 
-def analyze_entry_with_gemini(entry_text, uid):
+def analyze_entry_with_gemini(entry_text, uid, rate_limiter=None, max_retries=0):
     """
     Analyze a diary entry using Gemini API to create/update user virtual profile.
     Extracts personality traits, emotional patterns, interests, habits, and behavioral insights.
+    rate_limiter / max_retries are used by the batch job to respect Gemini quotas.
     """
-    if not model or not GEMINI_API_KEY:
+    if not llm_client.is_configured():
         print("⚠️ Gemini API not configured. Skipping analysis.")
         return None
     
@@ -614,11 +1704,15 @@ Please provide analysis in the following JSON format:
 
 Be specific, insightful, and nuanced. Look for both explicit and implicit information."""
 
-        response = model.generate_content(prompt)
+        response_text = llm_client.generate_text(
+            prompt,
+            llm_client.ANALYSIS_MODEL,
+            rate_limiter=rate_limiter,
+            max_retries=max_retries
+        )
         
         # Parse the response
         import json
-        response_text = response.text
         
         # Try to extract JSON from the response
         try:
@@ -644,98 +1738,323 @@ Be specific, insightful, and nuanced. Look for both explicit and implicit inform
         return None
 
 
+# Batch settings for the nightly analysis (match these to the Gemini quota)
+ANALYSIS_JOB_WORKERS = int(os.getenv('ANALYSIS_JOB_WORKERS', '4'))
+ANALYSIS_JOB_RPM = float(os.getenv('ANALYSIS_JOB_RPM', '60'))
+ANALYSIS_JOB_MAX_RETRIES = int(os.getenv('ANALYSIS_JOB_MAX_RETRIES', '4'))
+ANALYSIS_JOB_CHECKPOINT_EVERY = int(os.getenv('ANALYSIS_JOB_CHECKPOINT_EVERY', '25'))
+
+analysis_rate_limiter = llm_client.token_bucket(rate=ANALYSIS_JOB_RPM / 60.0, capacity=ANALYSIS_JOB_WORKERS)
+
+
+def get_analysis_checkpoint_ref():
+    """Firestore document holding the daily job's progress checkpoint"""
+    return db.collection('artifacts').document('default-journal-app-id').collection('job_state').document('daily_analysis_job')
+
+
+def entry_content_hash(entry_text):
+    """Stable fingerprint of the analyzed entry text"""
+    return hashlib.sha256(entry_text.encode('utf-8')).hexdigest()
+
+
+def get_analysis_watermark_ref(uid):
+    """Per-user document recording which entry version was last analyzed"""
+    return db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('job_state').document('analysis')
+
+
+# The merged "current" profile keeps list fields across analyses (newest
+# first, capped) and only the last PROFILE_SNAPSHOTS_KEEP snapshots are kept
+PROFILE_LIST_MAX = int(os.getenv('PROFILE_LIST_MAX', '15'))
+PROFILE_SNAPSHOTS_KEEP = int(os.getenv('PROFILE_SNAPSHOTS_KEEP', '30'))
+PROFILE_PRUNE_SLACK = 10
+
+
+def get_current_profile_ref(uid):
+    """Merged virtual profile read by the chat path (one document get)"""
+    return db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('profile').document('current')
+
+
+def merge_profile(current, analysis):
+    """
+    Merge a new analysis into the current profile: list fields are unioned
+    (new items first, case-insensitive dedup, capped at PROFILE_LIST_MAX),
+    every other field takes the newest value.
+    """
+    merged = dict(current or {})
+    for key, value in analysis.items():
+        previous = merged.get(key)
+        if isinstance(value, list) and isinstance(previous, list):
+            seen = set()
+            combined = []
+            for item in value + previous:
+                marker = str(item).strip().lower()
+                if marker and marker not in seen:
+                    seen.add(marker)
+                    combined.append(item)
+            merged[key] = combined[:PROFILE_LIST_MAX]
+        else:
+            merged[key] = value
+    return merged
+
+
+def save_analysis(uid, analysis, entry_id, content_hash):
+    """
+    Store a new virtual_profile snapshot, fold it into the merged current
+    profile and advance the user's analysis watermark in one transaction.
+    Old snapshots are pruned once there are PROFILE_PRUNE_SLACK too many.
+    """
+    user_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid)
+    current_ref = get_current_profile_ref(uid)
+    timestamp_str = datetime.utcnow().isoformat()
+
+    @firestore.transactional
+    def save(transaction):
+        current_doc = current_ref.get(transaction=transaction)
+        current = current_doc.to_dict() if current_doc.exists else {}
+        merged = merge_profile(current, analysis)
+        merged['snapshot_id'] = timestamp_str
+        merged['analysis_count'] = current.get('analysis_count', 0) + 1
+        merged['snapshot_count'] = current.get('snapshot_count', 0) + 1
+        merged['updated_at'] = datetime.utcnow()
+
+        transaction.set(user_ref.collection('virtual_profile').document(timestamp_str), analysis)
+        transaction.set(current_ref, merged)
+        transaction.set(get_analysis_watermark_ref(uid), {
+            'entry_id': entry_id,
+            'content_hash': content_hash,
+            'analyzed_at': datetime.utcnow()
+        })
+        return merged['snapshot_count']
+
+    snapshot_count = save(db.transaction())
+    if snapshot_count > PROFILE_SNAPSHOTS_KEEP + PROFILE_PRUNE_SLACK:
+        prune_profile_snapshots(uid)
+    
+    # Used by both daily_analysis_job and manual_analysis
+    invalidate_user_context(uid)
+
+
+def prune_profile_snapshots(uid):
+    """Delete all but the newest PROFILE_SNAPSHOTS_KEEP virtual_profile snapshots"""
+    profile_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('virtual_profile')
+    old_snapshots = profile_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).offset(PROFILE_SNAPSHOTS_KEEP).select([]).stream()
+    
+    deleted = 0
+    batch = db.batch()
+    for snapshot in old_snapshots:
+        batch.delete(snapshot.reference)
+        deleted += 1
+        if deleted % 400 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.set(get_current_profile_ref(uid), {'snapshot_count': PROFILE_SNAPSHOTS_KEEP}, merge=True)
+    batch.commit()
+    print(f"🧹 Pruned {deleted} old profile snapshot(s) for user {uid}")
+
+
+def analyze_user_latest_entry(uid):
+    """
+    Analyze one user's most recent entry and store the result in their
+    virtual_profile collection, unless that exact entry content was already
+    analyzed. Returns 'analyzed', 'unchanged' or 'no_entry'.
+    """
+    users_ref = db.collection('artifacts').document('default-journal-app-id').collection('users')
+
+    # Get the most recently edited entry
+    entries_ref = users_ref.document(uid).collection('entries')
+    entries_query = entries_ref.order_by('updated_at', direction=firestore.Query.DESCENDING).limit(1)
+
+    entry_doc = None
+    for entry_doc in entries_query.stream():
+        break
+
+    entry_text = entry_plain_text(entry_doc.to_dict()) if entry_doc else ''
+    if not entry_text:
+        return 'no_entry'
+
+    # Skip users whose latest entry has not changed since the last analysis
+    content_hash = entry_content_hash(entry_text)
+    watermark_doc = get_analysis_watermark_ref(uid).get()
+    if watermark_doc.exists:
+        watermark = watermark_doc.to_dict()
+        if watermark.get('entry_id') == entry_doc.id and watermark.get('content_hash') == content_hash:
+            return 'unchanged'
+
+    # Analyze the entry
+    analysis = analyze_entry_with_gemini(
+        entry_text,
+        uid,
+        rate_limiter=analysis_rate_limiter,
+        max_retries=ANALYSIS_JOB_MAX_RETRIES
+    )
+    if not analysis:
+        raise RuntimeError('Gemini analysis failed')
+
+    save_analysis(uid, analysis, entry_doc.id, content_hash)
+    return 'analyzed'
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
 def daily_analysis_job():
     """
     Scheduled job that runs daily at 12 AM (UTC).
-    Fetches all users' latest entries and runs Gemini analysis.
+    Fetches all users' latest entries and runs Gemini analysis through a
+    bounded worker pool and a shared rate limiter. Progress is checkpointed
+    (last fully processed uid, in document-id order) so a run interrupted by a
+    crash resumes where it stopped instead of starting over.
     """
-    print(f"\n🔄 Running daily virtual profile analysis job at {datetime.utcnow()}")
-    
+    run_id = datetime.utcnow().strftime('%Y-%m-%d')
+    print(f"\n🔄 Running daily virtual profile analysis job at {datetime.utcnow()} (run {run_id})")
+
     try:
-        # Get all users
+        checkpoint_ref = get_analysis_checkpoint_ref()
+        checkpoint_doc = checkpoint_ref.get()
+        checkpoint = checkpoint_doc.to_dict() if checkpoint_doc.exists else {}
+
+        resume_after = None
+        stats = {'analyzed': 0, 'unchanged': 0, 'skipped': 0, 'failed': 0, 'processed': 0}
+        if checkpoint.get('run_id') == run_id and checkpoint.get('status') == 'running':
+            resume_after = checkpoint.get('last_uid')
+            for key in stats:
+                stats[key] = checkpoint.get(key, 0)
+            print(f"  ↪️ Resuming run {run_id} after user {resume_after}")
+        elif checkpoint.get('run_id') == run_id and checkpoint.get('status') == 'completed':
+            print(f"  ✓ Run {run_id} already completed, nothing to do")
+            return
+
+        # User documents only exist as parents of their subcollections, which
+        # queries skip; list_documents() returns them without reading anything
         users_ref = db.collection('artifacts').document('default-journal-app-id').collection('users')
-        users = users_ref.stream()
-        
-        analysis_count = 0
-        
-        for user_doc in users:
-            uid = user_doc.id
-            
+        uids = sorted(user_ref.id for user_ref in users_ref.list_documents())
+        if resume_after:
+            uids = [uid for uid in uids if uid > resume_after]
+
+        def save_checkpoint(last_uid, status='running'):
+            checkpoint_ref.set({
+                'run_id': run_id,
+                'status': status,
+                'last_uid': last_uid,
+                'updated_at': datetime.utcnow(),
+                **stats
+            })
+
+        def timed_analysis(uid):
+            started = time.perf_counter()
+            outcome = analyze_user_latest_entry(uid)
+            return outcome, time.perf_counter() - started
+
+        latencies = []
+        last_uid = resume_after
+        started = time.perf_counter()
+        save_checkpoint(last_uid)
+
+        def collect(uid, future):
+            nonlocal last_uid
             try:
-                # Get the most recent entry (check last 24 hours)
-                entries_ref = users_ref.document(uid).collection('entries')
-                
-                # Get today's entry (most recent)
-                entries_query = entries_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1)
-                recent_entries = entries_query.stream()
-                
-                entry_to_analyze = None
-                for entry_doc in recent_entries:
-                    entry_data = entry_doc.to_dict()
-                    entry_to_analyze = entry_data
-                    break
-                
-                if not entry_to_analyze or not entry_to_analyze.get('text'):
-                    continue
-                
-                # Analyze the entry
-                analysis = analyze_entry_with_gemini(entry_to_analyze.get('text', ''), uid)
-                
-                if analysis:
-                    # Save to virtual_profile collection
-                    profile_ref = users_ref.document(uid).collection('virtual_profile')
-                    
-                    # Save analysis with timestamp as document ID
-                    timestamp_str = datetime.utcnow().isoformat()
-                    profile_ref.document(timestamp_str).set(analysis)
-                    
-                    analysis_count += 1
+                outcome, elapsed = future.result()
+                latencies.append(elapsed)
+                if outcome == 'analyzed':
+                    stats['analyzed'] += 1
                     print(f"✅ Analyzed entry for user {uid}")
-                    
+                elif outcome == 'unchanged':
+                    stats['unchanged'] += 1
+                else:
+                    stats['skipped'] += 1
             except Exception as e:
+                stats['failed'] += 1
                 print(f"⚠️ Error processing user {uid}: {e}")
-                continue
-        
-        print(f"✅ Daily analysis job completed. Analyzed {analysis_count} users.")
-        
+
+            # Results are collected in submission order, so every uid up to
+            # this one is done and the checkpoint can safely move past it
+            stats['processed'] += 1
+            last_uid = uid
+            if stats['processed'] % ANALYSIS_JOB_CHECKPOINT_EVERY == 0:
+                save_checkpoint(last_uid)
+
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=ANALYSIS_JOB_WORKERS, thread_name_prefix='daily-analysis') as pool:
+            for uid in uids:
+                in_flight.append((uid, pool.submit(timed_analysis, uid)))
+                # Keep at most two tasks per worker queued
+                while len(in_flight) >= ANALYSIS_JOB_WORKERS * 2:
+                    collect(*in_flight.popleft())
+            while in_flight:
+                collect(*in_flight.popleft())
+
+        save_checkpoint(last_uid, status='completed')
+
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        throughput = (len(latencies) / elapsed * 60) if elapsed > 0 else 0
+        print(f"✅ Daily analysis job completed. Analyzed {stats['analyzed']} users.")
+        print(f"   Processed: {stats['processed']} | Unchanged: {stats['unchanged']} | "
+              f"Skipped: {stats['skipped']} | Failed: {stats['failed']}")
+        print(f"   Duration: {elapsed:.1f}s | Throughput: {throughput:.1f} users/min")
+        if latencies:
+            print(f"   Latency per user: avg {sum(latencies) / len(latencies):.2f}s | "
+                  f"p50 {_percentile(latencies, 50):.2f}s | p95 {_percentile(latencies, 95):.2f}s | "
+                  f"max {latencies[-1]:.2f}s")
+
     except Exception as e:
         print(f"❌ Error in daily_analysis_job: {e}")
 
 
+def resume_interrupted_analysis():
+    """Queue an immediate run if today's analysis was interrupted mid-way"""
+    try:
+        checkpoint_doc = get_analysis_checkpoint_ref().get()
+        checkpoint = checkpoint_doc.to_dict() if checkpoint_doc.exists else {}
+        if checkpoint.get('status') == 'running' and checkpoint.get('run_id') == datetime.utcnow().strftime('%Y-%m-%d'):
+            scheduler.add_job(
+                func=daily_analysis_job,
+                id='daily_analysis_resume',
+                name='Resume Daily Virtual Profile Analysis',
+                replace_existing=True
+            )
+            print(f"↪️ Interrupted analysis run found, resuming after {checkpoint.get('last_uid')}")
+    except Exception as e:
+        print(f"⚠️ Could not check analysis checkpoint: {e}")
+
+
 @app.route('/api/analyze-now', methods=['POST'])
 @auth_required
 def manual_analysis():
     """Manually trigger analysis for current user's latest entry (for testing)"""
-    if not model or not GEMINI_API_KEY:
+    if not llm_client.is_configured():
         return jsonify({'error': 'Gemini API not configured'}), 500
     
     try:
         uid = session['user']['uid']
         
-        # Get the most recent entry
+        # Get the most recently edited entry
         entries_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entries')
-        entries_query = entries_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1)
+        entries_query = entries_ref.order_by('updated_at', direction=firestore.Query.DESCENDING).limit(1)
         recent_entries = entries_query.stream()
         
-        entry_to_analyze = None
+        entry_text = ''
         for entry_doc in recent_entries:
-            entry_to_analyze = entry_doc.to_dict()
+            entry_text = entry_plain_text(entry_doc.to_dict())
             break
-        
-        if not entry_to_analyze or not entry_to_analyze.get('text'):
+
+        if not entry_text:
             return jsonify({'error': 'No entry found to analyze'}), 404
-        
-        # Analyze the entry
-        analysis = analyze_entry_with_gemini(entry_to_analyze.get('text', ''), uid)
-        
+
+        # Analyze the entry (always, even if unchanged - this is the manual override)
+        analysis = analyze_entry_with_gemini(entry_text, uid)
+
         if not analysis:
             return jsonify({'error': 'Failed to analyze entry'}), 500
-        
-        # Save to virtual_profile collection
-        profile_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('virtual_profile')
-        timestamp_str = datetime.utcnow().isoformat()
-        profile_ref.document(timestamp_str).set(analysis)
-        
+
+        # Save to virtual_profile collection and advance the watermark so
+        # the nightly job does not re-analyze the same entry
+        save_analysis(uid, analysis, entry_doc.id, entry_content_hash(entry_text))
+
         return jsonify({
             'success': True,
             'message': 'Entry analyzed and profile updated',
@@ -750,48 +2069,218 @@ def manual_analysis():
 # ==================== FUMIKO AI INTEGRATION ====================
 
 
-def get_past_7_days_entries(uid):
-    """Fetch the past 7 days of diary entries for a user"""
+def invalidate_user_context(uid):
+    """Drop cached chat context after the user's entries or profile change"""
+    context_cache.invalidate_user(uid)
+
+
+def invalidate_user_entries(uid):
+    """Drop everything derived from the user's entries (chat context + entry list)"""
+    context_cache.invalidate_user(uid)
+    entries_cache.invalidate_user(uid)
+
+
+# Background media ingestion (spooled files + local job table)
+media_jobs = media_job_queue(
+    MEDIA_JOBS_DB,
+    MEDIA_SPOOL_DIR,
+    workers=MEDIA_JOB_WORKERS,
+    max_attempts=MEDIA_JOB_MAX_ATTEMPTS,
+    on_complete=lambda uid, date_id: invalidate_user_entries(uid)
+)
+media_jobs.start()
+
+
+# Relevance-ranked retrieval over the whole journal for chat context
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '3'))
+RETRIEVAL_MIN_SCORE = float(os.getenv('RETRIEVAL_MIN_SCORE', '0.08'))
+RETRIEVAL_SNIPPET_CHARS = int(os.getenv('RETRIEVAL_SNIPPET_CHARS', '400'))
+
+
+def get_vector_index_ref(uid):
+    """State of the per-user vector index (complete flag and vector dimensions)"""
+    return db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entry_index').document('vectors')
+
+
+def get_vector_shard_ref(uid, date_id):
+    """Monthly document of the vector index holding the entry's vector"""
+    return db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('vector_index').document(shard_id(date_id))
+
+
+def entry_vector(entry_data):
+    """Quantized vector of an entry's title and plain text"""
+    return quantize(embed(f"{entry_data.get('title', '')} {entry_plain_text(entry_data)}"))
+
+
+def rebuild_vector_index(uid):
+    """
+    Vectorize every entry of the user into the monthly vector shards (entries
+    written before the index existed, while it was a single document, or
+    with another VECTOR_DIM)
+    """
+    entries_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entries')
+    vectors = {doc.id: entry_vector(doc.to_dict()) for doc in entries_ref.stream()}
+    
+    shards = {}
+    for date_id, vector in vectors.items():
+        shards.setdefault(shard_id(date_id), {})[date_id] = vector
+    batch = db.batch()
+    for month, month_vectors in shards.items():
+        batch.set(get_vector_shard_ref(uid, month), {'vectors': month_vectors})
+    batch.set(get_vector_index_ref(uid), {'vectors': firestore.DELETE_FIELD, 'dim': VECTOR_DIM, 'complete': True, 'sharded': True}, merge=True)
+    batch.commit()
+    print(f"🧭 Rebuilt vector index for user {uid}: {len(vectors)} entries in {len(shards)} shard(s)")
+    return vectors
+
+
+def load_vector_index(uid):
+    """The user's entry vectors as a searchable matrix, built from the monthly shards (cached per uid)"""
+    def load():
+        index_doc = get_vector_index_ref(uid).get()
+        index = index_doc.to_dict() if index_doc.exists else {}
+        if not index.get('complete') or not index.get('sharded') or index.get('dim') != VECTOR_DIM:
+            return vector_index(rebuild_vector_index(uid))
+        
+        shards_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('vector_index')
+        vectors = {}
+        for shard_doc in shards_ref.stream():
+            vectors.update(shard_doc.to_dict().get('vectors', {}))
+        return vector_index(vectors)
+    
+    return context_cache.get_or_load(('vector_index', uid), load)
+
+
+def get_relevant_entries(uid, message, k=RETRIEVAL_TOP_K):
+    """
+    The k entries most related to the chat message, each reduced to its best
+    matching passage. When nothing is related (e.g. "hi") the most recent
+    entries are used instead. Only the k chosen entry documents are read.
+    """
     try:
-        entries_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entries')
+        index = load_vector_index(uid)
+        if not len(index):
+            return []
         
-        # Get entries from the last 7 days
-        seven_days_ago = datetime.utcnow() - timedelta(days=7)
+        query = embed(message or '')
+        hits = index.search(query, k, RETRIEVAL_MIN_SCORE)
+        if not hits:
+            # date_ids sort chronologically
+            hits = [(doc_id, 0.0) for doc_id in reversed(index.ids[-k:])]
         
-        entries_query = entries_ref.where('timestamp', '>=', seven_days_ago).order_by('timestamp', direction=firestore.Query.DESCENDING)
-        entries = entries_query.stream()
-        
-        past_entries = []
-        for entry_doc in entries:
-            entry_data = entry_doc.to_dict()
-            entry_data['date_id'] = entry_doc.id
-            past_entries.append(entry_data)
-        
-        return past_entries
+        entries_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('entries')
+        docs = {doc.id: doc for doc in db.get_all([entries_ref.document(doc_id) for doc_id, _ in hits]) if doc.exists}
         
+        relevant = []
+        for doc_id, score in hits:
+            if doc_id not in docs:
+                continue
+            entry = docs[doc_id].to_dict()
+            relevant.append({
+                'date_id': doc_id,
+                'title': entry.get('title', ''),
+                'text': best_passage(entry_plain_text(entry), query, RETRIEVAL_SNIPPET_CHARS),
+                'score': round(score, 3)
+            })
+        return relevant
     except Exception as e:
-        print(f"Error fetching past entries: {e}")
+        print(f"Error fetching relevant entries: {e}")
         return []
 
 
 def get_user_virtual_profile(uid):
-    """Fetch the most recent virtual profile for a user"""
-    try:
+    """Fetch the user's merged current virtual profile (cached per uid)"""
+    def load():
+        current_doc = get_current_profile_ref(uid).get()
+        if current_doc.exists:
+            return current_doc.to_dict()
+        
+        # Users analyzed before the current profile existed: seed it once
+        # from their most recent snapshot
         profile_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(uid).collection('virtual_profile')
-        
-        # Get the most recent profile
-        profiles = profile_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).stream()
-        
-        for profile_doc in profiles:
-            return profile_doc.to_dict()
+        for profile_doc in profile_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).stream():
+            profile = dict(profile_doc.to_dict(), snapshot_id=profile_doc.id, analysis_count=1, updated_at=datetime.utcnow())
+            get_current_profile_ref(uid).set(profile)
+            return profile
         
         return None
-        
+    
+    try:
+        return context_cache.get_or_load(('virtual_profile', uid), load)
     except Exception as e:
         print(f"Error fetching virtual profile: {e}")
         return None
 
 
+# Per-source timeouts (seconds) for the chat context fan-out
+CONTEXT_SOURCE_TIMEOUTS = {
+    'past_entries': float(os.getenv('CONTEXT_TIMEOUT_PAST_ENTRIES', '3')),
+    'virtual_profile': float(os.getenv('CONTEXT_TIMEOUT_VIRTUAL_PROFILE', '3')),
+    'chat_history': float(os.getenv('CONTEXT_TIMEOUT_CHAT_HISTORY', '3')),
+    'chat_memory': float(os.getenv('CONTEXT_TIMEOUT_CHAT_MEMORY', '3')),
+}
+
+# Shared pool so the Firestore reads of one chat request run side by side
+context_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('CONTEXT_FETCH_WORKERS', '12')),
+    thread_name_prefix='chat-context'
+)
+
+
+def _timed_call(func, *args, **kwargs):
+    """Run func and return (result, elapsed milliseconds)"""
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, round((time.perf_counter() - started) * 1000, 1)
+
+
+def gather_chat_context(uid, model_name='fumiko', history_limit=CHAT_CONTEXT_MESSAGES + CHAT_MEMORY_COMPACT_EVERY, message=''):
+    """
+    Fetch the entries relevant to the message, virtual profile, recent chat
+    history and the rolling chat memory concurrently. Only the messages not
+    yet folded into the memory are kept (at most history_limit), so nothing
+    falls between the summary and the recent history.
+    Each source has its own timeout; a source that fails or times out falls
+    back to an empty value so the chat can still be answered with partial context.
+    Returns (context, timings) where timings holds per-source milliseconds
+    (None for sources that did not complete).
+    """
+    sources = {
+        'past_entries': (get_relevant_entries, (uid, message), {}, []),
+        'virtual_profile': (get_user_virtual_profile, (uid,), {}, None),
+        'chat_history': (get_chat_history, (uid,), {'limit': history_limit, 'model_name': model_name}, []),
+        'chat_memory': (get_chat_memory, (uid, model_name), {}, {'summary': '', 'compacted_until': None}),
+    }
+    
+    started = time.perf_counter()
+    futures = {
+        name: context_executor.submit(_timed_call, func, *args, **kwargs)
+        for name, (func, args, kwargs, _) in sources.items()
+    }
+    
+    context = {}
+    timings = {}
+    for name, future in futures.items():
+        fallback = sources[name][3]
+        remaining = CONTEXT_SOURCE_TIMEOUTS[name] - (time.perf_counter() - started)
+        try:
+            context[name], timings[name] = future.result(timeout=max(remaining, 0))
+        except FuturesTimeoutError:
+            future.cancel()
+            print(f"    ⚠️ Timed out fetching {name} after {CONTEXT_SOURCE_TIMEOUTS[name]}s")
+            context[name], timings[name] = fallback, None
+        except Exception as e:
+            print(f"    ⚠️ Error fetching {name}: {e}")
+            context[name], timings[name] = fallback, None
+    
+    compacted_until = context['chat_memory'].get('compacted_until')
+    if compacted_until:
+        context['chat_history'] = [m for m in context['chat_history'] if m.get('timestamp') and m['timestamp'] > compacted_until]
+    context['chat_memory'] = context['chat_memory'].get('summary', '')
+    
+    timings['total'] = round((time.perf_counter() - started) * 1000, 1)
+    return context, timings
+
+
 def get_current_entry(uid):
     """Fetch the current/latest diary entry for a user"""
     try:
@@ -827,23 +2316,85 @@ def get_current_entry(uid):
 @app.route('/api/fumiko-history', methods=['GET'])
 @auth_required
 def get_fumiko_history():
-    """Get all chat history with Fumiko"""
+    """Get chat history with Fumiko (cursor paginated)"""
     try:
         uid = session['user']['uid']
-        limit = request.args.get('limit', 50, type=int)
+        try:
+            limit, cursor, fields = parse_page_args(CHAT_HISTORY_PAGE_SIZE, CHAT_HISTORY_MAX_PAGE_SIZE, CHAT_MESSAGE_FIELDS, CHAT_CURSOR_FIELDS)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        chat_history = get_chat_history(uid, limit=limit)
+        chat_history, next_cursor = get_chat_history_page(uid, 'fumiko', limit, cursor, fields)
         
-        return jsonify({
+        return conditional_json({
             'success': True,
-            'messages': chat_history
-        }), 200
+            'messages': chat_history,
+            'next_cursor': next_cursor
+        })
         
     except Exception as e:
         print(f"Error in get_fumiko_history: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+# ==================== MAINTENANCE COMMANDS ====================
+
+@app.cli.command('migrate-inline-media')
+@click.option('--uid', default=None, help='Only migrate entries of this user.')
+@click.option('--dry-run', is_flag=True, help='Report inline media without uploading anything.')
+def migrate_inline_media(uid, dry_run):
+    """Move base64 media stored inside entry documents to Cloudinary (one-off)"""
+    users_ref = db.collection('artifacts').document('default-journal-app-id').collection('users')
+    # list_documents() also returns user documents that only exist as the
+    # parent of their entries (queries skip those)
+    uids = [uid] if uid else [user_ref.id for user_ref in users_ref.list_documents()]
+    stats = {'entries': 0, 'blocks': 0, 'migrated': 0, 'failed': 0}
+    
+    for user_id in uids:
+        user_changed = False
+        for entry_doc in users_ref.document(user_id).collection('entries').stream():
+            blocks = entry_doc.to_dict().get('blocks', [])
+            inline = [idx for idx, block in enumerate(blocks) if is_data_url(block.get('url'))]
+            if not inline:
+                continue
+            
+            stats['entries'] += 1
+            stats['blocks'] += len(inline)
+            print(f"📄 {user_id}/{entry_doc.id}: {len(inline)} inline media block(s)")
+            if dry_run:
+                continue
+            
+            for idx in inline:
+                block = blocks[idx]
+                try:
+                    file_name = block.get('fileName') or f"{block.get('type', 'media')}-{block.get('id') or idx}"
+                    url = upload_media(data_url_to_file(block['url'], file_name), user_id, entry_doc.id)
+                except (ValueError, binascii.Error) as e:
+                    print(f"  ❌ Block {idx}: could not decode inline data: {e}")
+                    url = None
+                if url:
+                    block['url'] = url
+                    stats['migrated'] += 1
+                else:
+                    stats['failed'] += 1
+            
+            entry_doc.reference.update({'blocks': blocks})
+            user_changed = True
+        
+        if user_changed:
+            invalidate_user_entries(user_id)
+    
+    print(f"✅ Inline media migration {'(dry run) ' if dry_run else ''}finished: {stats}")
+
+
+@app.cli.command('retry-failed-media')
+@click.option('--uid', default=None, help='Only retry uploads of this user.')
+def retry_failed_media(uid):
+    """Requeue background media uploads that failed permanently"""
+    requeued = media_jobs.retry_failed(uid)
+    print(f"🔁 Requeued {requeued} failed media upload job(s)")
+
+
 # ==================== SCHEDULER SETUP ====================
 
 scheduler = BackgroundScheduler()
@@ -864,6 +2415,7 @@ def start_scheduler():
     if not scheduler.running:
         scheduler.start()
         print("✅ Scheduler started - Daily analysis scheduled for 12:00 AM UTC")
+        resume_interrupted_analysis()
 
 def stop_scheduler():
     """Stop the background scheduler"""
@@ -871,8 +2423,18 @@ def stop_scheduler():
         scheduler.shutdown()
         print("✅ Scheduler stopped")
 
+def shutdown_background_tasks():
+    """Stop the scheduler, media workers and flush buffered chat history writes"""
+    stop_scheduler()
+    media_jobs.stop()
+    # At exit the compaction executor no longer accepts work, so the final
+    # flush counts its messages synchronously (see on_chat_history_flushed)
+    chat_history_writer.close()
+    compaction_executor.shutdown(wait=False)
+    print(f"✅ Chat history writer flushed: {chat_history_writer.stats()}")
+
 # Register shutdown handler
-atexit.register(stop_scheduler)
+atexit.register(shutdown_background_tasks)
 
 
 if __name__ == '__main__':
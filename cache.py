@@ -0,0 +1,188 @@
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 'memory' (per-process) or 'redis' (shared by every gunicorn worker)
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+###########################################################################################
+                        #'''in-process ttl + lru cache '''
+
+
+class ttl_lru_cache:
+    """
+    Small thread-safe cache: entries expire after `ttl` seconds and the least
+    recently used entry is evicted once `max_entries` is reached.
+    Keys are tuples whose second element is the uid, so everything cached
+    for a user can be dropped at once with invalidate_user().
+    """
+    def __init__(self, name, ttl=300, max_entries=2048):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """Return (found, value); expired entries count as misses"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.counters['hits'] += 1
+                    return True, value
+                del self._data[key]
+            self.counters['misses'] += 1
+            return False, None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def get_or_load(self, key, loader):
+        """Serve key from cache, or call loader() and cache its result (exceptions are not cached)"""
+        found, value = self.get(key)
+        if found:
+            return value
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.counters['invalidations'] += 1
+
+    def invalidate_user(self, uid):
+        """Drop every cached value belonging to uid"""
+        with self._lock:
+            for key in [k for k in self._data if len(k) > 1 and k[1] == uid]:
+                del self._data[key]
+                self.counters['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self._data)
+        stats['backend'] = 'memory'
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
+
+
+###########################################################################################
+                        #'''shared redis-protocol cache '''
+
+
+class redis_cache:
+    """
+    Same interface as ttl_lru_cache, backed by a Redis-protocol server so all
+    workers share one coherent copy. Every (cache name, uid) pair is one Redis
+    hash, which makes invalidate_user() a single DEL visible to every worker.
+    Backend errors are logged and treated as misses so a cache outage only
+    costs extra Firestore reads.
+    """
+    def __init__(self, name, ttl=300, url=None, client=None, prefix='journal'):
+        if client is None:
+            import redis  # optional dependency, only needed for this backend
+            client = redis.Redis.from_url(url or REDIS_URL)
+        self.name = name
+        self.ttl = ttl
+        self.prefix = prefix
+        self.client = client
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'invalidations': 0, 'errors': 0}
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _hash_key(self, key):
+        return f"{self.prefix}:{self.name}:{key[1]}"
+
+    def _field(self, key):
+        return repr((key[0],) + tuple(key[2:]))
+
+    def get(self, key):
+        """Return (found, value); expired or unreadable entries count as misses"""
+        try:
+            raw = self.client.hget(self._hash_key(key), self._field(key))
+            if raw is not None:
+                expires_at, value = pickle.loads(raw)
+                if expires_at > time.time():
+                    self._count('hits')
+                    return True, value
+        except Exception as e:
+            print(f"⚠️ {self.name} cache read failed: {e}")
+            self._count('errors')
+        self._count('misses')
+        return False, None
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        hash_key = self._hash_key(key)
+        try:
+            pipe = self.client.pipeline()
+            pipe.hset(hash_key, self._field(key), pickle.dumps((time.time() + ttl, value)))
+            pipe.expire(hash_key, int(ttl) + 1)
+            pipe.execute()
+        except Exception as e:
+            print(f"⚠️ {self.name} cache write failed: {e}")
+            self._count('errors')
+
+    def get_or_load(self, key, loader):
+        """Serve key from cache, or call loader() and cache its result (exceptions are not cached)"""
+        found, value = self.get(key)
+        if found:
+            return value
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        try:
+            self.client.hdel(self._hash_key(key), self._field(key))
+            self._count('invalidations')
+        except Exception as e:
+            print(f"⚠️ {self.name} cache invalidation failed: {e}")
+            self._count('errors')
+
+    def invalidate_user(self, uid):
+        """Drop every cached value belonging to uid, for all workers"""
+        try:
+            self.client.delete(f"{self.prefix}:{self.name}:{uid}")
+            self._count('invalidations')
+        except Exception as e:
+            print(f"⚠️ {self.name} cache invalidation failed: {e}")
+            self._count('errors')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['backend'] = 'redis'
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
+
+
+def create_cache(name, ttl=300, max_entries=2048):
+    """Build a cache on the configured backend (CACHE_BACKEND), falling back to memory"""
+    if CACHE_BACKEND == 'redis':
+        try:
+            return redis_cache(name, ttl=ttl)
+        except ImportError:
+            print(f"⚠️ CACHE_BACKEND=redis but the redis package is not installed; {name} cache stays in memory")
+    return ttl_lru_cache(name, ttl=ttl, max_entries=max_entries)
@@ -5,6 +5,16 @@ from dotenv import load_dotenv
 import cloudinary
 import cloudinary.uploader
 import traceback
+import threading
+import queue
+import time
+import hashlib
+import base64
+import mimetypes
+import tempfile
+from urllib.parse import unquote_to_bytes
+from werkzeug.datastructures import FileStorage
+from concurrent.futures import ThreadPoolExecutor
 from firebase_config import db
 
 load_dotenv()
@@ -16,6 +26,10 @@ CLOUDINARY_CLOUD_NAME = os.getenv('CLOUDINARY_CLOUD_NAME')
 CLOUDINARY_API_KEY = os.getenv('CLOUDINARY_API_KEY')
 CLOUDINARY_API_SECRET = os.getenv('CLOUDINARY_API_SECRET')
 
+# Bounded pool shared by all requests so concurrent saves cannot flood Cloudinary
+MEDIA_UPLOAD_WORKERS = int(os.getenv('MEDIA_UPLOAD_WORKERS', '4'))
+upload_executor = ThreadPoolExecutor(max_workers=MEDIA_UPLOAD_WORKERS, thread_name_prefix='media-upload')
+
 # File Upload Utility Function (Now uses Cloudinary)
 def upload_file_to_cloudinary(file, uid, date_id):
     """
@@ -57,7 +71,260 @@ def upload_file_to_cloudinary(file, uid, date_id):
         return None
 
 
+# Inline media (data: URLs) is converted to real files before upload
+def is_data_url(value):
+    return isinstance(value, str) and value.startswith('data:')
+
+
+def data_url_to_file(data_url, file_name='inline-media', chunk_size=1024 * 1024):
+    """
+    Decode a data: URL into a file object, chunk by chunk into a spooled
+    temporary file, so the decoded bytes are never held in memory as one
+    extra copy. Raises ValueError for malformed data.
+    """
+    header, separator, payload = data_url.partition(',')
+    if not separator:
+        raise ValueError('Malformed data URL')
+    mime_type = header[5:].split(';')[0] or 'application/octet-stream'
+
+    spooled = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    if header.endswith(';base64'):
+        if any(c.isspace() for c in payload[:1024]):
+            payload = ''.join(payload.split())
+        step = chunk_size - chunk_size % 4
+        for start in range(0, len(payload), step):
+            spooled.write(base64.b64decode(payload[start:start + step], validate=True))
+    else:
+        spooled.write(unquote_to_bytes(payload))
+    spooled.seek(0)
+
+    extension = mimetypes.guess_extension(mime_type) or ''
+    return FileStorage(stream=spooled, filename=f"{file_name}{extension}", content_type=mime_type)
+
+
+# Content-addressed media index: users/{uid}/media_index/{sha256} -> url
+def hash_file(file, chunk_size=1024 * 1024):
+    """SHA-256 of a file object, read in chunks; the file pointer is reset afterwards"""
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def get_media_index_ref(uid):
+    return db.collection('artifacts').document(APP_ID).collection('users').document(uid).collection('media_index')
+
+
+def lookup_media_hashes(uid, content_hashes):
+    """Return {hash: url} for the hashes this user already uploaded (one get_all RPC)"""
+    content_hashes = set(content_hashes)
+    if not content_hashes:
+        return {}
+    try:
+        index_ref = get_media_index_ref(uid)
+        known = {}
+        for snapshot in db.get_all([index_ref.document(h) for h in content_hashes]):
+            if snapshot.exists and snapshot.to_dict().get('url'):
+                known[snapshot.id] = snapshot.to_dict()['url']
+        return known
+    except Exception as e:
+        print(f"⚠️ Media index lookup failed, uploading without dedup: {e}")
+        return {}
+
+
+def record_media_hash(uid, content_hash, url, file_name=None):
+    """Remember the URL of uploaded content so identical files are never uploaded again"""
+    try:
+        get_media_index_ref(uid).document(content_hash).set({
+            'url': url,
+            'file_name': file_name,
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+    except Exception as e:
+        print(f"⚠️ Could not record media hash: {e}")
+
+
+def upload_media(file, uid, date_id, content_hash=None):
+    """
+    Upload a file unless the same bytes were already uploaded by this user,
+    in which case the stored URL is returned without touching Cloudinary.
+    """
+    content_hash = content_hash or hash_file(file)
+    known_url = lookup_media_hashes(uid, [content_hash]).get(content_hash)
+    if known_url:
+        print(f"♻️ Skipping upload of {file.filename}: identical file already uploaded")
+        return known_url
+
+    url = upload_file_to_cloudinary(file, uid, date_id)
+    if url:
+        record_media_hash(uid, content_hash, url, file.filename)
+    return url
+
+
+def upload_files_concurrently(uploads, uid, date_id, content_hashes=None):
+    """
+    Upload several files at once through the shared upload pool.
+    `uploads` is a list of (key, file); returns {key: {'url', 'elapsed_ms', 'error'}}
+    so callers can stitch results back in their own order.
+    `content_hashes` ({key: sha256}) avoids hashing files a second time.
+    """
+    content_hashes = content_hashes or {}
+
+    def timed_upload(key, file):
+        started = time.perf_counter()
+        url = upload_media(file, uid, date_id, content_hashes.get(key))
+        return url, round((time.perf_counter() - started) * 1000, 1)
+
+    futures = {key: upload_executor.submit(timed_upload, key, file) for key, file in uploads}
+
+    results = {}
+    for key, future in futures.items():
+        try:
+            url, elapsed_ms = future.result()
+            results[key] = {'url': url, 'elapsed_ms': elapsed_ms, 'error': None if url else 'Upload failed'}
+        except Exception as e:
+            results[key] = {'url': None, 'elapsed_ms': None, 'error': str(e)}
+    return results
+
+
+# Write-behind queue for Firestore writes that do not need to block a request
+class write_behind_queue:
+    """
+    Accepts (document_ref, data) pairs, acknowledges immediately and commits
+    them from a background thread in Firestore batched writes.
+    The queue is bounded: when it is full the write happens synchronously
+    instead, so nothing is dropped under back-pressure.
+    on_flush(items) is called after each committed batch (and after each
+    synchronous write, with that single item).
+    """
+    # Firestore rejects batches with more than 500 writes
+    MAX_BATCH_SIZE = 500
+
+    def __init__(self, name, max_size=1000, batch_size=100, flush_interval=0.5, max_retries=3, on_flush=None):
+        self.name = name
+        self.on_flush = on_flush
+        self.batch_size = min(batch_size, self.MAX_BATCH_SIZE)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self.metrics = {
+            'enqueued': 0,
+            'written': 0,
+            'failed': 0,
+            'direct_writes': 0,
+            'flushes': 0,
+            'max_queue_depth': 0,
+            'last_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+
+    def _ensure_started(self):
+        # Started lazily (and again after a fork) so every gunicorn worker runs its own flusher
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-writer", daemon=True)
+            self._thread.start()
+
+    def enqueue(self, doc_ref, data):
+        """Queue one document write; returns as soon as it is buffered"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((doc_ref, data))
+        except queue.Full:
+            print(f"⚠️ {self.name} queue full, writing synchronously")
+            doc_ref.set(data)
+            with self._metrics_lock:
+                self.metrics['direct_writes'] += 1
+            self._notify([(doc_ref, data)])
+            return
+        with self._metrics_lock:
+            self.metrics['enqueued'] += 1
+            self.metrics['max_queue_depth'] = max(self.metrics['max_queue_depth'], self._queue.qsize())
+
+    def _drain(self, timeout):
+        items = []
+        try:
+            items.append(self._queue.get(timeout=timeout))
+        except queue.Empty:
+            return items
+        while len(items) < self.batch_size:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _flush(self, items):
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                batch = db.batch()
+                for doc_ref, data in items:
+                    batch.set(doc_ref, data)
+                batch.commit()
+                break
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    print(f"❌ {self.name} flush failed, dropping {len(items)} writes: {e}")
+                    with self._metrics_lock:
+                        self.metrics['failed'] += len(items)
+                    return
+                time.sleep(0.5 * (2 ** attempt))
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._metrics_lock:
+            self.metrics['written'] += len(items)
+            self.metrics['flushes'] += 1
+            self.metrics['last_flush_ms'] = round(elapsed_ms, 1)
+            self.metrics['total_flush_ms'] += elapsed_ms
+
+        self._notify(items)
+
+    def _notify(self, items):
+        if self.on_flush:
+            try:
+                self.on_flush(items)
+            except Exception as e:
+                print(f"⚠️ {self.name} on_flush callback failed: {e}")
 
+    def _run(self):
+        while not self._stop.is_set():
+            items = self._drain(self.flush_interval)
+            if items:
+                self._flush(items)
 
+    def flush(self):
+        """Synchronously write everything still buffered"""
+        while True:
+            items = self._drain(timeout=0)
+            if not items:
+                return
+            self._flush(items)
 
+    def close(self, timeout=5):
+        """Stop the background writer and flush what is left (used at shutdown)"""
+        self._stop.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout)
+        self.flush()
 
+    def stats(self):
+        """Snapshot of queue depth and flush metrics"""
+        with self._metrics_lock:
+            stats = dict(self.metrics)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['avg_flush_ms'] = round(stats['total_flush_ms'] / stats['flushes'], 1) if stats['flushes'] else 0.0
+        stats['total_flush_ms'] = round(stats['total_flush_ms'], 1)
+        return stats
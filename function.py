@@ -1,50 +1,43 @@
 import os 
 from dotenv import load_dotenv
 import traceback
+import threading
+import time
 from firebase_config import db
-import google.generativeai as genai
+import llm_client
 from dotenv import load_dotenv
 # from firebase_admin import firestore
 load_dotenv()
 
 ###########################################################################################
                         #'''setting up gemini '''
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+# Model objects and connections are shared through llm_client
 
-def send_gemini_prompt(prompt_text, model="gemini-2.5-flash"):
+def send_gemini_prompt(prompt_text, model=llm_client.CHAT_MODEL):
     try:
-        model_obj = genai.GenerativeModel(model)
-        response = model_obj.generate_content(prompt_text)
-        return response.text
+        return llm_client.generate_text(prompt_text, model)
     except Exception as e:
         return f"an error occurred: {e}"
-                    
+
+def stream_gemini_prompt(prompt_text, model=llm_client.CHAT_MODEL):
+    """Yield reply text chunk by chunk as Gemini generates it (errors propagate)"""
+    return llm_client.stream_text(prompt_text, model)
+
 ###############################################################################################
+                        #'''persona registry & prompt templates '''
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-class chat_system:
-    def __init__(self,current_entry,old_entries,chat_history,virtual_profile):
-        self.current_entry=current_entry
-        self.old_entries=old_entries
-        self.chat_history=chat_history
-        self.virtual_profile=virtual_profile
-    def chat_krishna(self,message):
-        
-        #################### fetching clone persona ################################
-        with open ('krsihan.txt','r') as f :
-            krishna=f.read()
-        ####################  sysytem guidelines ##########################
-        prompt=''
-        
-        response=send_gemini_prompt(prompt)
-        return response 
-    def chat_fumiko(self,message):
+PERSONA_FILES = {
+    'fumiko': 'fumiko.txt',
+    'krishna': 'krsihan.txt',
+}
 
-        ######################## fetching clone persona #################################
-        with open ('fumiko.txt','r') as f :
-            clone_persona=f.read()
-        ######################## sysytem guidelines ######################################
-        prompt = f"""### SYSTEM INSTRUCTION
+# How often (seconds) a persona file is stat'ed for changes on the chat path
+PERSONA_RELOAD_INTERVAL = float(os.getenv('PERSONA_RELOAD_INTERVAL', '5'))
+
+# Static part of the prompt: rendered once per persona load, never per request
+FUMIKO_PREFIX_TEMPLATE = """### SYSTEM INSTRUCTION
 You are **FUMIKO**.
 You are NOT a standard AI assistant. You are a specific personality with a distinct history, voice, and relationship to the user.
 Your goal is to act as a **deeply perceptive companion**. You must read between the lines of the user's diary entries to help them find clarity, spot patterns in their life, or simply feel heard—all while maintaining your unique character flawlessly.
@@ -66,16 +59,21 @@ Your goal is to act as a **deeply perceptive companion**. You must read between
 You have access to the user's mind map. Use these data sources intelligently:
 
 **A. [VIRTUAL_PROFILE] (Who they are)**
-{self.virtual_profile}
+"""
+
+# Per-user part of the prompt: the only section assembled on every message
+FUMIKO_CONTEXT_TEMPLATE = """{virtual_profile}
 
-**B. [PAST_ENTRIES] (Pattern Recognition - Last 7 Days)**
-{self.old_entries}
+**B. [PAST_ENTRIES] (Pattern Recognition - Most Relevant Past Entries)**
+{old_entries}
 
 **C. [CURRENT_ENTRY] (Immediate Focus)**
-{self.current_entry}
+{current_entry}
 
 **D. [RECENT CONVERSATION] (Memory)**
-{self.chat_history}
+Earlier conversations (summary): {chat_memory}
+
+{chat_history}
 
 ---
 
@@ -101,10 +99,294 @@ User's Message: "{message}"
 
 Your Response (as Fumiko):"""
 
+PROMPT_TEMPLATES = {
+    'fumiko': (FUMIKO_PREFIX_TEMPLATE, FUMIKO_CONTEXT_TEMPLATE),
+    # Krishna's guidelines are not written yet
+    'krishna': ('', ''),
+}
+
+
+class persona_registry:
+    """
+    Keeps every persona file in memory along with its pre-rendered static
+    prompt prefix. Files are re-read only when their mtime changes, and the
+    mtime itself is checked at most once per reload interval.
+    """
+    def __init__(self, persona_files, templates, reload_interval=PERSONA_RELOAD_INTERVAL):
+        self.persona_files = persona_files
+        self.templates = templates
+        self.reload_interval = reload_interval
+        self._personas = {}
+        self._lock = threading.Lock()
+        for name in persona_files:
+            self._load(name)
+
+    def _path(self, name):
+        return os.path.join(BASE_DIR, self.persona_files[name])
+
+    def _load(self, name):
+        path = self._path(name)
+        try:
+            mtime = os.path.getmtime(path)
+            with open(path, 'r') as f:
+                text = f.read()
+        except OSError as e:
+            print(f"⚠️ Persona '{name}' could not be loaded from {path}: {e}")
+            mtime, text = None, ''
+
+        prefix_template, context_template = self.templates.get(name, ('', ''))
+        persona = {
+            'name': name,
+            'text': text,
+            'mtime': mtime,
+            'checked_at': time.monotonic(),
+            'prefix': prefix_template.format(clone_persona=text) if prefix_template else '',
+            'context_template': context_template,
+        }
+        self._personas[name] = persona
+        return persona
+
+    def get(self, name):
+        """Return the cached persona, reloading it if the file changed on disk"""
+        if name not in self.persona_files:
+            raise KeyError(f"Unknown persona: {name}")
+
+        persona = self._personas.get(name)
+        if persona and time.monotonic() - persona['checked_at'] < self.reload_interval:
+            return persona
+
+        with self._lock:
+            persona = self._personas.get(name)
+            if persona is None:
+                return self._load(name)
+            try:
+                mtime = os.path.getmtime(self._path(name))
+            except OSError:
+                mtime = None
+            if mtime != persona['mtime']:
+                print(f"🔄 Persona '{name}' changed on disk, reloading")
+                return self._load(name)
+            persona['checked_at'] = time.monotonic()
+            return persona
+
+    def render(self, name, **context):
+        """Build the full prompt: cached static prefix + per-user context section"""
+        persona = self.get(name)
+        if not persona['context_template']:
+            return persona['prefix']
+        return persona['prefix'] + persona['context_template'].format(**context)
+
+
+# Loaded once at import (i.e. worker startup)
+personas = persona_registry(PERSONA_FILES, PROMPT_TEMPLATES)
+
+###############################################################################################
+                        #'''prompt context assembly '''
+
+# Token budget for the per-user context part of the prompt. Sections are listed
+# in priority order: when the total is exceeded, lower sections are cut first.
+PROMPT_CONTEXT_TOKENS = int(os.getenv('PROMPT_CONTEXT_TOKENS', '2000'))
+PROMPT_SECTION_TOKENS = {
+    'current_entry': int(os.getenv('PROMPT_TOKENS_CURRENT_ENTRY', '800')),
+    'chat_history': int(os.getenv('PROMPT_TOKENS_CHAT_HISTORY', '500')),
+    'chat_memory': int(os.getenv('PROMPT_TOKENS_CHAT_MEMORY', '300')),
+    'virtual_profile': int(os.getenv('PROMPT_TOKENS_VIRTUAL_PROFILE', '300')),
+    'old_entries': int(os.getenv('PROMPT_TOKENS_OLD_ENTRIES', '600')),
+}
+
+# Rough chars-per-token ratio; counting locally avoids a count_tokens round-trip
+CHARS_PER_TOKEN = 4
+
+MEDIA_BLOCK_TYPES = ('image', 'video', 'document', 'voice')
+
+# Most telling profile fields first; bookkeeping fields are never sent
+PROFILE_FIELD_ORDER = ('summary', 'emotional_state', 'personality_traits', 'challenges_concerns',
+                       'values_priorities', 'interests_hobbies', 'habits_patterns',
+                       'relationship_insights', 'behavioral_insights', 'mental_health_indicators')
+PROFILE_SKIP_FIELDS = ('timestamp', 'uid', 'snapshot_id', 'analysis_count', 'snapshot_count', 'updated_at')
+
+
+def estimate_tokens(text):
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def compact_text(text):
+    """Collapse all whitespace runs to single spaces"""
+    return ' '.join(str(text).split())
+
+
+def entry_plain_text(entry):
+    """Plain text of an entry: block text and captions, media reduced to a short tag"""
+    if not entry:
+        return ''
+    if isinstance(entry, str):
+        return compact_text(entry)
+
+    parts = []
+    for block in entry.get('blocks') or []:
+        if block.get('type') in MEDIA_BLOCK_TYPES:
+            label = block.get('caption') or block.get('fileName') or ''
+            parts.append(f"[{block['type']}: {label}]" if label else f"[{block['type']}]")
+            continue
+        for key in ('text', 'caption'):
+            if block.get(key):
+                parts.append(block[key])
+    if not parts and entry.get('text'):
+        parts.append(entry['text'])
+    return compact_text(' '.join(parts))
+
+
+def format_entry(entry):
+    text = entry_plain_text(entry)
+    header = ' - '.join(str(entry[key]) for key in ('date_id', 'title') if entry.get(key))
+    return f"{header}: {text}" if header else text
+
+
+def format_chat_history(chat_history, assistant_name):
+    """One compact exchange per stored message, newest first"""
+    lines = []
+    for msg in reversed(chat_history or []):
+        exchange = f"User: {compact_text(msg.get('message', ''))}"
+        if msg.get('response'):
+            exchange += f"\n{assistant_name}: {compact_text(msg['response'])}"
+        lines.append(exchange)
+    return lines
+
+
+def format_virtual_profile(profile):
+    """One 'field: value' line per non-empty profile field, most telling first"""
+    if not profile:
+        return []
+    keys = [k for k in PROFILE_FIELD_ORDER if k in profile]
+    keys += sorted(k for k in profile if k not in PROFILE_FIELD_ORDER and k not in PROFILE_SKIP_FIELDS)
+
+    lines = []
+    for key in keys:
+        value = profile[key]
+        if value in (None, '', [], {}):
+            continue
+        if isinstance(value, (list, tuple)):
+            value = ', '.join(str(v) for v in value)
+        elif isinstance(value, dict):
+            value = '; '.join(f"{k}: {v}" for k, v in value.items())
+        lines.append(f"{key.replace('_', ' ')}: {compact_text(value)}")
+    return lines
+
+
+def trim_items(items, max_chars, min_fragment=40):
+    """Keep items in order while they fit; the first one that does not is truncated if worthwhile"""
+    kept = []
+    used = 0
+    for item in items:
+        cost = len(item) + (1 if kept else 0)
+        if used + cost <= max_chars:
+            kept.append(item)
+            used += cost
+            continue
+        room = max_chars - used - (1 if kept else 0) - 1
+        if room >= min_fragment:
+            kept.append(item[:room].rstrip() + '…')
+        break
+    return kept
+
+
+class context_assembler:
+    """
+    Turns raw Firestore context into compact prompt sections that fit a
+    token budget. Each section is first capped at its own budget; spare room
+    then goes to the sections that were cut, in priority order, and the total
+    is enforced by cutting the lowest-priority sections first.
+    """
+    def __init__(self, total_budget=PROMPT_CONTEXT_TOKENS, section_budgets=None):
+        self.total_budget = total_budget
+        self.section_budgets = section_budgets or PROMPT_SECTION_TOKENS
+        self.priority = list(self.section_budgets)
+
+    def allocate(self, needed):
+        """Token allowance per section given what each section would need in full"""
+        alloc = {name: min(needed[name], self.section_budgets[name]) for name in self.priority}
+
+        over = sum(alloc.values()) - self.total_budget
+        for name in reversed(self.priority):
+            if over <= 0:
+                break
+            cut = min(over, alloc[name])
+            alloc[name] -= cut
+            over -= cut
+
+        spare = self.total_budget - sum(alloc.values())
+        for name in self.priority:
+            if spare <= 0:
+                break
+            extra = min(spare, needed[name] - alloc[name])
+            alloc[name] += extra
+            spare -= extra
+        return alloc
+
+    def assemble(self, current_entry, old_entries, chat_history, virtual_profile, assistant_name='Fumiko', chat_memory=None):
+        """Return ({section: text}, {section: estimated tokens})"""
+        items = {
+            'current_entry': [entry_plain_text(current_entry)] if current_entry else [],
+            'chat_history': format_chat_history(chat_history, assistant_name),
+            'chat_memory': [compact_text(chat_memory)] if chat_memory else [],
+            'virtual_profile': format_virtual_profile(virtual_profile),
+            'old_entries': [format_entry(entry) for entry in old_entries or [] if entry_plain_text(entry)],
+        }
+        needed = {name: estimate_tokens('\n'.join(items[name])) for name in self.priority}
+        alloc = self.allocate(needed)
+
+        sections = {}
+        usage = {}
+        for name in self.priority:
+            kept = trim_items(items[name], alloc[name] * CHARS_PER_TOKEN)
+            if name == 'chat_history':
+                kept.reverse()  # back to chronological order
+            sections[name] = '\n'.join(kept) if kept else '(none)'
+            usage[name] = estimate_tokens(sections[name])
+        return sections, usage
+
+
+context_budget = context_assembler()
+
+###############################################################################################
+
+
+class chat_system:
+    def __init__(self,current_entry,old_entries,chat_history,virtual_profile,chat_memory=None):
+        self.current_entry=current_entry
+        self.old_entries=old_entries
+        self.chat_history=chat_history
+        self.virtual_profile=virtual_profile
+        self.chat_memory=chat_memory
+    def build_prompt(self,persona,message):
+        sections,self.context_usage=context_budget.assemble(
+            self.current_entry,
+            self.old_entries,
+            self.chat_history,
+            self.virtual_profile,
+            assistant_name=persona.capitalize(),
+            chat_memory=self.chat_memory,
+        )
+        return personas.render(persona, message=message, **sections)
+    def chat_krishna(self,message):
+        
+        #################### cached clone persona + sysytem guidelines ################
+        prompt=self.build_prompt('krishna',message)
+        
+        response=send_gemini_prompt(prompt)
+        return response 
+    def chat_fumiko(self,message):
+
+        ######################## cached clone persona + sysytem guidelines ##############
+        prompt=self.build_prompt('fumiko',message)
+
         response=send_gemini_prompt(prompt)
         return response
+    def stream_fumiko(self,message):
+        prompt=self.build_prompt('fumiko',message)
+        return stream_gemini_prompt(prompt)
 
 ##################################sending reels############################################# 
 
 
-                                
\ No newline at end of file
+                                
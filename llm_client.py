@@ -0,0 +1,120 @@
+import os
+import random
+import threading
+import time
+from dotenv import load_dotenv
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+load_dotenv()
+
+###########################################################################################
+                        #'''shared gemini client '''
+
+GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+
+# Model names are configurable per use case
+CHAT_MODEL = os.getenv('GEMINI_CHAT_MODEL', 'gemini-2.5-flash')
+ANALYSIS_MODEL = os.getenv('GEMINI_ANALYSIS_MODEL', 'gemini-pro')
+
+# 'grpc' (default) or 'rest'; either way genai keeps one process-wide
+# transport client, so every cached model shares its connections
+GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT') or None
+
+if GEMINI_API_KEY:
+    genai.configure(api_key=GEMINI_API_KEY, transport=GEMINI_TRANSPORT)
+else:
+    print("⚠️ Warning: GEMINI_API_KEY not found in environment variables")
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def is_configured():
+    """True when a Gemini API key is available"""
+    return bool(GEMINI_API_KEY)
+
+
+def get_model(model_name=None):
+    """Return the cached GenerativeModel for model_name, creating it on first use"""
+    model_name = model_name or CHAT_MODEL
+    model_obj = _models.get(model_name)
+    if model_obj is None:
+        with _models_lock:
+            model_obj = _models.get(model_name)
+            if model_obj is None:
+                model_obj = genai.GenerativeModel(model_name)
+                _models[model_name] = model_obj
+    return model_obj
+
+
+# Quota (429) and server-side (5xx) failures are worth retrying
+RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.GatewayTimeout,
+)
+
+
+class token_bucket:
+    """
+    Thread-safe token bucket: `rate` tokens per second refill a bucket of
+    `capacity`. acquire() blocks until a token is available.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def generate_text(prompt_text, model_name=None, rate_limiter=None, max_retries=0,
+                  backoff_base=1.0, backoff_max=30.0):
+    """
+    Run a blocking generation and return the reply text (errors propagate).
+    Optionally waits on a token_bucket before each attempt and retries
+    429/5xx failures with jittered exponential backoff.
+    """
+    attempt = 0
+    while True:
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            response = get_model(model_name).generate_content(prompt_text)
+            return response.text
+        except RETRYABLE_ERRORS as e:
+            if attempt >= max_retries:
+                raise
+            delay = min(backoff_max, backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+            print(f"⚠️ Gemini call failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+def stream_text(prompt_text, model_name=None):
+    """Yield reply text chunk by chunk as Gemini generates it (errors propagate)"""
+    response = get_model(model_name).generate_content(prompt_text, stream=True)
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # chunk carried no text parts (e.g. safety metadata only)
+            continue
+        if text:
+            yield text
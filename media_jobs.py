@@ -0,0 +1,316 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from werkzeug.datastructures import FileStorage
+from firebase_admin import firestore
+from firebase_config import db
+from crud import upload_media
+
+###########################################################################################
+                        #'''background media ingestion '''
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MEDIA_SPOOL_DIR = os.getenv('MEDIA_SPOOL_DIR', os.path.join(BASE_DIR, 'uploads', 'pending'))
+MEDIA_JOBS_DB = os.getenv('MEDIA_JOBS_DB', os.path.join(BASE_DIR, 'uploads', 'media_jobs.sqlite3'))
+MEDIA_JOB_WORKERS = int(os.getenv('MEDIA_JOB_WORKERS', '2'))
+MEDIA_JOB_MAX_ATTEMPTS = int(os.getenv('MEDIA_JOB_MAX_ATTEMPTS', '3'))
+
+# An 'uploading' job untouched for this long belongs to a dead worker and is retried
+STALE_JOB_SECONDS = 600
+
+
+class media_job_queue:
+    """
+    Persistent queue of pending media uploads.
+    Request handlers spool the uploaded file to disk and record a job row in
+    a local SQLite table. Worker threads claim jobs, upload them to
+    Cloudinary and patch the matching block of the Firestore entry.
+    Jobs survive restarts, and every gunicorn worker on the host drains
+    the same table.
+    """
+    def __init__(self, db_path, spool_dir, workers=2, max_attempts=3, poll_interval=1.0, on_complete=None):
+        self.db_path = db_path
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.on_complete = on_complete
+        self._local = threading.local()
+        self._threads = []
+        self._pid = None
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+        os.makedirs(self.spool_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._init_schema()
+
+    def _conn(self):
+        # sqlite connections must not be shared across threads (or forks)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_schema(self):
+        self._conn().execute('''
+            CREATE TABLE IF NOT EXISTS media_jobs (
+                id TEXT PRIMARY KEY,
+                uid TEXT NOT NULL,
+                date_id TEXT NOT NULL,
+                block_id TEXT,
+                block_index INTEGER,
+                block_type TEXT,
+                file_name TEXT,
+                file_path TEXT,
+                status TEXT NOT NULL,
+                url TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        columns = {row['name'] for row in self._conn().execute('PRAGMA table_info(media_jobs)')}
+        if 'content_hash' not in columns:
+            self._conn().execute('ALTER TABLE media_jobs ADD COLUMN content_hash TEXT')
+        self._conn().execute('CREATE INDEX IF NOT EXISTS media_jobs_entry ON media_jobs (uid, date_id)')
+        self._conn().execute('CREATE INDEX IF NOT EXISTS media_jobs_status ON media_jobs (status, available_at)')
+
+    def start(self):
+        """Start the worker threads (again after a fork) if they are not running"""
+        if self._pid == os.getpid() and any(t.is_alive() for t in self._threads):
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and any(t.is_alive() for t in self._threads):
+                return
+            self._stop.clear()
+            self._pid = os.getpid()
+            self._threads = [
+                threading.Thread(target=self._run, name=f"media-job-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self):
+        """Ask workers to stop; unfinished jobs stay in the table and resume later"""
+        self._stop.set()
+
+    @staticmethod
+    def new_job_id():
+        return uuid.uuid4().hex
+
+    def submit(self, job_id, uid, date_id, block_id, block_index, block_type, file, content_hash=None):
+        """Spool the uploaded file to disk and queue it for upload"""
+        file_path = os.path.join(self.spool_dir, job_id)
+        file.seek(0)
+        file.save(file_path)
+        now = time.time()
+        self._conn().execute(
+            'INSERT INTO media_jobs (id, uid, date_id, block_id, block_index, block_type, file_name, '
+            'file_path, content_hash, status, attempts, available_at, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?)',
+            (job_id, uid, date_id, block_id, block_index, block_type, file.filename,
+             file_path, content_hash, 'pending', now, now, now)
+        )
+        self.start()
+        return job_id
+
+    def _claim(self):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                "SELECT * FROM media_jobs WHERE (status = 'pending' AND available_at <= ?) "
+                "OR (status = 'uploading' AND updated_at <= ?) ORDER BY created_at LIMIT 1",
+                (now, now - STALE_JOB_SECONDS)
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                "UPDATE media_jobs SET status = 'uploading', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (now, row['id'])
+            )
+            conn.execute('COMMIT')
+            job = dict(row)
+            job['attempts'] += 1
+            return job
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        self._conn().execute(f"UPDATE media_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def _patch_entry_block(self, job, **block_fields):
+        """
+        Update the block carrying this job id inside the Firestore entry.
+        A block re-saved by a client that dropped the job id is matched by
+        its block id, as long as it has no media of its own yet.
+        """
+        entry_ref = db.collection('artifacts').document('default-journal-app-id').collection('users').document(job['uid']).collection('entries').document(job['date_id'])
+
+        @firestore.transactional
+        def patch(transaction):
+            snapshot = entry_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return False
+            blocks = snapshot.to_dict().get('blocks', [])
+            targets = [block for block in blocks if block.get('media_job_id') == job['id']]
+            if not targets and job.get('block_id') is not None:
+                targets = [
+                    block for block in blocks
+                    if str(block.get('id')) == str(job['block_id'])
+                    and not block.get('url') and not block.get('media_job_id')
+                ]
+            for block in targets:
+                block.update(block_fields)
+                if block_fields.get('url'):
+                    block.pop('media_job_id', None)
+            patched = bool(targets)
+            if patched:
+                transaction.update(entry_ref, {'blocks': blocks})
+            return patched
+
+        return patch(db.transaction())
+
+    def _process(self, job):
+        started = time.perf_counter()
+        try:
+            with open(job['file_path'], 'rb') as stream:
+                file = FileStorage(stream=stream, filename=job['file_name'])
+                url = upload_media(file, job['uid'], job['date_id'], job.get('content_hash'))
+        except OSError as e:
+            url = None
+            print(f"❌ Media job {job['id']}: spooled file unavailable: {e}")
+
+        if url:
+            # Recorded before the entry is patched, so a save racing with
+            # this job always sees either the patched block or the done job
+            self._update(job['id'], status='done', url=url, error=None)
+            self._remove_spool_file(job)
+            try:
+                patched = self._patch_entry_block(job, url=url, media_status='ready')
+            except Exception as e:
+                # The next save of the entry picks the URL up from the job table
+                print(f"⚠️ Media job {job['id']}: uploaded but could not patch the entry: {e}")
+                patched = False
+            elapsed = time.perf_counter() - started
+            print(f"✅ Media job {job['id']} done in {elapsed:.1f}s (entry {'patched' if patched else 'no longer references it'})")
+        elif not self._retry_or_fail(job, 'Upload failed'):
+            return
+
+        if self.on_complete:
+            self.on_complete(job['uid'], job['date_id'])
+
+    def _retry_or_fail(self, job, error):
+        """
+        Requeue the job with exponential backoff while it has attempts left,
+        otherwise mark it (and its block) failed. Returns True once it failed.
+        """
+        if job['attempts'] < self.max_attempts:
+            delay = 5 * (2 ** (job['attempts'] - 1))
+            self._update(job['id'], status='pending', error=error, available_at=time.time() + delay)
+            print(f"⚠️ Media job {job['id']} failed (attempt {job['attempts']}/{self.max_attempts}), retrying in {delay}s")
+            return False
+
+        # The spooled file is the only copy of the media: it stays on disk
+        # so the job can be requeued with retry_failed()
+        self._update(job['id'], status='failed', error=error)
+        try:
+            self._patch_entry_block(job, media_status='failed')
+        except Exception as e:
+            print(f"⚠️ Media job {job['id']}: could not mark block failed: {e}")
+        print(f"❌ Media job {job['id']} failed permanently after {job['attempts']} attempts (file kept at {job['file_path']})")
+        return True
+
+    def get_job(self, job_id):
+        """The job row as a dict, or None"""
+        row = self._conn().execute('SELECT * FROM media_jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def reapply(self, job_id):
+        """
+        Patch a finished job's outcome into its entry again, for a save that
+        re-linked the block while the job was finishing
+        """
+        job = self.get_job(job_id)
+        if job is None or job['status'] not in ('done', 'failed'):
+            return False
+        if job['status'] == 'done':
+            return self._patch_entry_block(job, url=job['url'], media_status='ready')
+        return self._patch_entry_block(job, media_status='failed')
+
+    def retry_failed(self, uid=None):
+        """Requeue failed jobs whose spooled file is still on disk; returns how many"""
+        query = "SELECT id, file_path FROM media_jobs WHERE status = 'failed'"
+        params = ()
+        if uid:
+            query += ' AND uid = ?'
+            params = (uid,)
+        requeued = 0
+        for row in self._conn().execute(query, params).fetchall():
+            if not os.path.exists(row['file_path']):
+                continue
+            self._update(row['id'], status='pending', attempts=0, error=None, available_at=time.time())
+            requeued += 1
+        if requeued:
+            self.start()
+        return requeued
+
+    def _remove_spool_file(self, job):
+        try:
+            os.remove(job['file_path'])
+        except OSError:
+            pass
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"⚠️ Media job claim failed: {e}")
+                job = None
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            try:
+                self._process(job)
+            except Exception as e:
+                print(f"❌ Media job {job['id']} crashed: {e}")
+                try:
+                    if self._retry_or_fail(job, str(e)) and self.on_complete:
+                        self.on_complete(job['uid'], job['date_id'])
+                except Exception as e:
+                    # Left 'uploading'; the stale-job sweep picks it up again
+                    print(f"⚠️ Media job {job['id']}: could not record the crash: {e}")
+
+    def status_for_entry(self, uid, date_id):
+        """All jobs of one entry, newest first"""
+        self.start()
+        rows = self._conn().execute(
+            'SELECT id, block_id, block_index, block_type, file_name, status, url, error, attempts, created_at, updated_at '
+            'FROM media_jobs WHERE uid = ? AND date_id = ? ORDER BY created_at DESC',
+            (uid, date_id)
+        ).fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            job['created_at'] = datetime.utcfromtimestamp(job['created_at']).isoformat()
+            job['updated_at'] = datetime.utcfromtimestamp(job['updated_at']).isoformat()
+            jobs.append(job)
+        return jobs
@@ -0,0 +1,123 @@
+import re
+import math
+from collections import defaultdict
+
+###########################################################################################
+                        #'''positional inverted index for entry search '''
+
+TOKEN_PATTERN = re.compile(r"\w+(?:'\w+)*")
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def tokenize(text):
+    """Lowercased word tokens, stopwords kept so phrase positions stay exact"""
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+def entry_search_text(entry):
+    """Searchable text of an entry: title, text blocks and captions"""
+    parts = [entry.get('title') or '']
+    for block in entry.get('blocks') or []:
+        parts.append(block.get('text') or '')
+        parts.append(block.get('caption') or '')
+    if not entry.get('blocks') and entry.get('text'):
+        parts.append(entry['text'])
+    return ' '.join(part for part in parts if part)
+
+
+def shard_id(date_id):
+    """Entries are stored in one index document per month (YYYY-MM)"""
+    return date_id[:7]
+
+
+def parse_query(query):
+    """Split a query into phrases (lists of tokens); bare words are one-token phrases"""
+    phrases = []
+    for quoted, word in QUERY_PATTERN.findall(query):
+        tokens = tokenize(quoted if quoted else word)
+        if tokens:
+            phrases.append(tokens)
+    return phrases
+
+
+class search_index:
+    """
+    In-memory positional inverted index of one user's entries, built from the
+    stored token streams ({date_id: {'title', 'tokens'}}). Supports AND
+    queries of words and quoted phrases, ranked by phrase frequency x idf.
+    """
+    def __init__(self, documents):
+        self.titles = {}
+        self.tokens = {}
+        self.postings = defaultdict(dict)
+        for date_id, document in documents.items():
+            tokens = (document.get('tokens') or '').split()
+            self.titles[date_id] = document.get('title', '')
+            self.tokens[date_id] = tokens
+            for position, token in enumerate(tokens):
+                self.postings[token].setdefault(date_id, []).append(position)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def _phrase_matches(self, phrase):
+        """{date_id: [start positions]} of entries containing the phrase"""
+        first = self.postings.get(phrase[0], {})
+        if len(phrase) == 1:
+            return first
+        rest = [self.postings.get(token, {}) for token in phrase[1:]]
+        matches = {}
+        for date_id, positions in first.items():
+            if not all(date_id in postings for postings in rest):
+                continue
+            following = [set(postings[date_id]) for postings in rest]
+            starts = [p for p in positions if all(p + i + 1 in following[i] for i in range(len(following)))]
+            if starts:
+                matches[date_id] = starts
+        return matches
+
+    def search(self, query, date_from=None, date_to=None, limit=20):
+        """Return (total, hits) for the entries matching every word/phrase, best first"""
+        phrases = parse_query(query)
+        if not phrases:
+            return 0, []
+
+        per_phrase = [self._phrase_matches(phrase) for phrase in phrases]
+        candidates = set(per_phrase[0])
+        for matches in per_phrase[1:]:
+            candidates &= set(matches)
+        if date_from:
+            candidates = {d for d in candidates if d >= date_from}
+        if date_to:
+            candidates = {d for d in candidates if d <= date_to}
+
+        total_docs = len(self.tokens)
+        scored = []
+        for date_id in candidates:
+            score = 0.0
+            for phrase, matches in zip(phrases, per_phrase):
+                idf = math.log(1 + total_docs / len(matches))
+                score += (1 + math.log(len(matches[date_id]))) * idf * len(phrase)
+            scored.append((score, date_id))
+        # Best score first, newer entries first on ties
+        scored.sort(reverse=True)
+
+        hits = []
+        for score, date_id in scored[:limit]:
+            start = per_phrase[0][date_id][0]
+            hits.append({
+                'date_id': date_id,
+                'title': self.titles.get(date_id, ''),
+                'score': round(score, 3),
+                'matches': sum(len(matches[date_id]) for matches in per_phrase),
+                'snippet': self.snippet(date_id, start, len(phrases[0]))
+            })
+        return len(scored), hits
+
+    def snippet(self, date_id, start, length, context=12):
+        """Tokens around a match, e.g. '… felt anxious all evening …'"""
+        tokens = self.tokens.get(date_id, [])
+        lo = max(0, start - context)
+        hi = min(len(tokens), start + length + context)
+        text = ' '.join(tokens[lo:hi])
+        return ('… ' if lo > 0 else '') + text + (' …' if hi < len(tokens) else '')
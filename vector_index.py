@@ -0,0 +1,110 @@
+import os
+import re
+import math
+import hashlib
+from collections import Counter
+import numpy as np
+
+###########################################################################################
+                        #'''hashed bag-of-words vectors for entry retrieval '''
+
+# Dimensions of the hashed vectors; changing it makes existing indexes rebuild
+VECTOR_DIM = int(os.getenv('VECTOR_DIM', '1024'))
+
+TOKEN_PATTERN = re.compile(r"[\w']+")
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+
+STOPWORDS = frozenset('''
+a about again all am an and any are as at be been but by can could did do does for from had has have
+he her hers him his how i i'm if in into is it it's its just me my myself no not of on or our out so
+some than that the their them then there these they this to too up us very was we were what when
+where which who why will with would you your
+'''.split())
+
+
+def tokenize(text):
+    """Lowercased word tokens without stopwords"""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) > 1 and token not in STOPWORDS]
+
+
+def _bucket(feature, dim):
+    # Stable across processes, unlike hash()
+    digest = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+    return digest % dim, (1.0 if digest >> 63 else -1.0)
+
+
+def embed(text, dim=VECTOR_DIM):
+    """
+    Signed feature-hashing vector of the text's unigrams and bigrams with
+    sublinear term frequency, L2-normalised (so a dot product is the cosine).
+    """
+    tokens = tokenize(text)
+    features = Counter(tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])])
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature, count in features.items():
+        index, sign = _bucket(feature, dim)
+        vector[index] += sign * (1.0 + math.log(count))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def quantize(vector):
+    """Pack a normalised vector as int8 bytes (dim bytes) for storage"""
+    return np.clip(np.round(vector * 127), -127, 127).astype(np.int8).tobytes()
+
+
+def dequantize(raw):
+    return np.frombuffer(raw, dtype=np.int8).astype(np.float32) / 127
+
+
+class vector_index:
+    """
+    One user's entry vectors as a single matrix; search() ranks every entry
+    by cosine similarity with one matrix-vector product.
+    """
+    def __init__(self, vectors, dim=VECTOR_DIM):
+        self.dim = dim
+        self.ids = []
+        rows = []
+        for doc_id in sorted(vectors):
+            raw = vectors[doc_id]
+            if raw is None or len(raw) != dim:
+                continue
+            self.ids.append(doc_id)
+            rows.append(dequantize(raw))
+        self.matrix = np.vstack(rows) if rows else np.zeros((0, dim), dtype=np.float32)
+        norms = np.linalg.norm(self.matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.matrix /= norms
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query_vector, k=3, min_score=0.0):
+        """Return up to k (doc_id, score) pairs, best first, scoring at least min_score"""
+        if not self.ids or not query_vector.any():
+            return []
+        scores = self.matrix @ query_vector
+        k = min(k, len(self.ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[i], float(scores[i])) for i in top if scores[i] >= min_score]
+
+
+def best_passage(text, query_vector, max_chars=400):
+    """The run of consecutive sentences (up to max_chars) most similar to the query"""
+    if len(text) <= max_chars:
+        return text
+
+    windows = []
+    current = ''
+    for sentence in SENTENCE_PATTERN.split(text):
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            windows.append(current)
+            current = ''
+        current = f"{current} {sentence}".strip()
+    if current:
+        windows.append(current)
+
+    best = max(windows, key=lambda window: float(embed(window, len(query_vector)) @ query_vector))
+    return best if len(best) <= max_chars else best[:max_chars - 1].rstrip() + '…'